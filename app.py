@@ -1,38 +1,744 @@
-from flask import Flask, render_template, request, send_file, jsonify, send_from_directory
+from flask import Flask, g, render_template, request, send_file, jsonify, send_from_directory, stream_with_context
 from typing import Optional, Tuple, Dict
 import subprocess
 import os
 import tempfile
 import uuid
 import shutil
-import google.generativeai as genai
+import click
 from dotenv import load_dotenv
-import PyPDF2
 import io
-import requests
-from bs4 import BeautifulSoup
+import base64
+import bisect
+import contextvars
+import difflib
+import functools
+import hashlib
+import heapq
+import hmac
+import gzip
+import importlib
+import zlib
 import re
 import json
+import math
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+from contextlib import contextmanager
 from datetime import datetime
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
 
+try:
+    import fcntl  # Cross-process journal locking (not available on Windows)
+except ImportError:
+    fcntl = None
+
+try:
+    import brotli  # Optional: preferred over gzip when installed
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image  # Optional: enables WebP thumbnails
+except ImportError:
+    Image = None
+
+
+
+class LazyModule:
+    """Stands in for a module and imports it on first attribute access.
+
+    The Gemini SDK alone takes most of a second to import, which every worker
+    (re)start would otherwise pay before serving its first request.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+genai = LazyModule('google.generativeai')
+PyPDF2 = LazyModule('PyPDF2')
+bs4 = LazyModule('bs4')
+requests = LazyModule('requests')
+
 load_dotenv()
 
 app = Flask(__name__)
 
-# Configure Gemini
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model_pro = genai.GenerativeModel('gemini-3-pro-preview')
-model_fast = genai.GenerativeModel('gemini-2.5-flash')
+
+def cooperative_io() -> bool:
+    """Whether gevent has patched this process (SERVER_MODE=async), making blocking I/O cooperative."""
+    monkey = sys.modules.get('gevent.monkey')
+    return bool(monkey and monkey.is_module_patched('socket'))
+
+
+# Configure Gemini - models are created on first use
+MODEL_PRO_NAME = 'gemini-3-pro-preview'
+MODEL_FAST_NAME = 'gemini-2.5-flash'
+_models: Dict[bool, object] = {}
+_models_lock = threading.Lock()
 
 def get_model(pro_mode: bool = False):
     """Get the appropriate model based on mode."""
-    return model_pro if pro_mode else model_fast
+    model = _models.get(pro_mode)
+    if model is None:
+        with _models_lock:
+            model = _models.get(pro_mode)
+            if model is None:
+                if not _models:
+                    # gRPC blocks gevent's event loop; the REST transport goes through patched sockets
+                    transport = os.getenv('GEMINI_TRANSPORT') or ('rest' if cooperative_io() else None)
+                    genai.configure(api_key=os.getenv('GEMINI_API_KEY'), transport=transport)
+                model = _models[pro_mode] = genai.GenerativeModel(MODEL_PRO_NAME if pro_mode else MODEL_FAST_NAME)
+    return model
+
+
+def generate_content(stage: str, pro_mode: bool, *args, **kwargs):
+    """Call the selected Gemini model, recording latency and outcome under `stage`."""
+    model_name = MODEL_PRO_NAME if pro_mode else MODEL_FAST_NAME
+    key = _fairness_key.get()
+    cost = get_admission_config()['pro_cost'] if pro_mode else 1
+    try:
+        with trace_span('model.wait'):
+            MODEL_SCHEDULER.acquire(key, cost=cost, weight=fairness_weight(key))
+    except Overloaded:
+        ADMISSION_REJECTED.inc(route='model', reason='queue')
+        raise
+    result = 'failure'
+    start = time.perf_counter()
+    try:
+        with MODEL_REQUESTS_IN_PROGRESS.track_in_progress(stage=stage), trace_span(f'model.{stage}'):
+            response = get_model(pro_mode).generate_content(*args, **kwargs)
+        result = 'success'
+        return response
+    finally:
+        MODEL_SCHEDULER.release()
+        MODEL_REQUEST_SECONDS.observe(time.perf_counter() - start, stage=stage, model=model_name)
+        MODEL_REQUESTS.inc(stage=stage, model=model_name, result=result)
 
 # Store generated PDFs temporarily - normalize path to avoid double slashes
 TEMP_DIR = os.path.normpath(os.path.join(tempfile.gettempdir(), 'latex_resumes'))
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+
+# Metrics - counters, gauges and histograms exposed on /metrics in Prometheus
+# text format. Every worker keeps its own values in memory and writes them to
+# METRICS_DIR every METRICS_FLUSH_INTERVAL seconds; /metrics merges the files of
+# all workers under the same gunicorn master, so any worker can answer a scrape.
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(TEMP_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+class Metric:
+    """One named counter, gauge or histogram with a fixed set of label names."""
+
+    def __init__(self, lock: threading.Lock, kind: str, name: str, help_text: str, labelnames=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets or ())
+        # {label values: number} or, for histograms, {label values: [bucket counts..., +Inf count, sum]}
+        self.values: Dict[tuple, object] = {}
+        self._lock = lock
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(self.buckets) + 2)
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def track_in_progress(self, **labels):
+        """Gauge of blocks currently running."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class MetricsRegistry:
+    """All metrics of this process, plus merging and rendering across workers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+        self._flusher_started = False
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _register(self, kind, name, help_text, labelnames=(), buckets=None) -> Metric:
+        metric = Metric(self._lock, kind, name, help_text, labelnames, buckets)
+        self._metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Metric:
+        return self._register('counter', name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames=()) -> Metric:
+        return self._register('gauge', name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=METRICS_BUCKETS) -> Metric:
+        return self._register('histogram', name, help_text, labelnames, buckets)
+
+    def _after_fork(self):
+        # A preloaded master's numbers must not be counted again by every worker
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = self._lock
+            metric.values = {}
+        self._flusher_started = False
+
+    def snapshot(self) -> dict:
+        """This process's values as plain JSON-able data."""
+        with self._lock:
+            return {
+                name: [[list(key), list(value) if isinstance(value, list) else value]
+                       for key, value in metric.values.items()]
+                for name, metric in self._metrics.items()
+            }
+
+    def _file_path(self, pid: int) -> str:
+        return os.path.join(METRICS_DIR, f'{os.getppid()}-{pid}.json')
+
+    def flush(self):
+        """Write this process's snapshot for other workers to merge."""
+        if not METRICS_DIR:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = self._file_path(os.getpid())
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self):
+        """Start the background thread that flushes periodically (once per process)."""
+        if self._flusher_started or not METRICS_DIR:
+            return
+        self._flusher_started = True
+
+        def run():
+            while True:
+                time.sleep(METRICS_FLUSH_INTERVAL)
+                try:
+                    self.flush()
+                except OSError as e:
+                    print(f"Error flushing metrics: {e}")
+
+        threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+    def _worker_snapshots(self) -> list:
+        """[(pid, snapshot)] for every worker of this server, including this one."""
+        snapshots = [(os.getpid(), self.snapshot())]
+        if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+            return snapshots
+        prefix = f'{os.getppid()}-'
+        for name in os.listdir(METRICS_DIR):
+            if not name.startswith(prefix) or not name.endswith('.json'):
+                continue
+            pid = int(name[len(prefix):-len('.json')])
+            if pid == os.getpid():
+                continue
+            try:
+                with open(os.path.join(METRICS_DIR, name)) as f:
+                    snapshots.append((pid, json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        if os.name != 'posix':
+            return True
+        try:
+            os.kill(pid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    def render(self) -> str:
+        """Merge all workers and render Prometheus text exposition format."""
+        merged: Dict[str, Dict[tuple, object]] = {name: {} for name in self._metrics}
+        for pid, snapshot in self._worker_snapshots():
+            alive = pid == os.getpid() or self._pid_alive(pid)
+            for name, entries in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue  # Gauges of exited workers no longer mean anything
+                values = merged[name]
+                for key, value in entries:
+                    key = tuple(key)
+                    if metric.kind == 'histogram':
+                        current = values.setdefault(key, [0] * len(value))
+                        values[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        values[key] = values.get(key, 0) + value
+
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(merged[name].items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else _format_number(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels + [("le", le)])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(value[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: list) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+               for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+METRICS = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = METRICS.histogram(
+    'resume_http_request_seconds', 'Time spent handling HTTP requests.', ['endpoint', 'method'])
+HTTP_REQUESTS = METRICS.counter(
+    'resume_http_requests_total', 'HTTP requests handled.', ['endpoint', 'method', 'status'])
+COMPILE_SECONDS = METRICS.histogram(
+    'resume_compile_seconds', 'Time to compile a LaTeX document, all passes included.', ['result'])
+PDFLATEX_PASS_SECONDS = METRICS.histogram(
+    'resume_pdflatex_pass_seconds', 'Time of a single pdflatex run.', ['run'])
+COMPILES_IN_PROGRESS = METRICS.gauge(
+    'resume_compiles_in_progress', 'LaTeX compiles currently running.')
+MODEL_REQUEST_SECONDS = METRICS.histogram(
+    'resume_model_request_seconds', 'Latency of Gemini calls.', ['stage', 'model'])
+MODEL_REQUESTS = METRICS.counter(
+    'resume_model_requests_total', 'Gemini calls by outcome.', ['stage', 'model', 'result'])
+MODEL_REQUESTS_IN_PROGRESS = METRICS.gauge(
+    'resume_model_requests_in_progress', 'Gemini calls currently waiting on a response.', ['stage'])
+SCRAPE_SECONDS = METRICS.histogram(
+    'resume_scrape_seconds', 'Time to scrape a URL, fetch and parse included.', ['kind'])
+SCRAPE_FETCHES = METRICS.counter(
+    'resume_scrape_fetches_total', 'URL fetches by outcome.', ['result'])
+HISTORY_SECONDS = METRICS.histogram(
+    'resume_history_seconds', 'Chat history store operations.', ['op', 'backend'])
+HISTORY_ERRORS = METRICS.counter(
+    'resume_history_errors_total', 'Chat history store operations that failed.', ['op', 'backend'])
+ADMISSION_REJECTED = METRICS.counter(
+    'resume_admission_rejected_total', 'Requests turned away by rate limits or full queues.', ['route', 'reason'])
+QUEUE_WAITING = METRICS.gauge(
+    'resume_queue_waiting', 'Requests waiting for a compile or model slot.', ['queue'])
+INCREMENTAL_COMPILES = METRICS.counter(
+    'resume_incremental_compiles_total', 'Session compiles by how much earlier work they reused.', ['mode'])
+INCREMENTAL_SAVED_SECONDS = METRICS.counter(
+    'resume_incremental_saved_seconds_total', 'Compile time saved by incremental compiles, against a full compile.')
+INCREMENTAL_LOST_SECONDS = METRICS.counter(
+    'resume_incremental_lost_seconds_total', 'Compile time lost by incremental compiles slower than a full compile.')
+
+# Tracing - every request gets a Trace; code on the /chat and /compile paths
+# wraps its stages in trace_span() and the spans come back in the Server-Timing
+# header (and, with TRACE_LOG=json, as one JSON log line per request). Work
+# handed to an executor keeps its trace when submitted through traced_submit().
+TRACE_LOG = os.getenv('TRACE_LOG', '').lower()
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 40))
+
+# Profiling - a request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`,
+# or at random with probability PROFILE_SAMPLE_RATE. A sampler thread records
+# the stacks of the threads working on the request every PROFILE_INTERVAL
+# seconds and writes them to PROFILE_DIR in collapsed-stack (flamegraph) format.
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(TEMP_DIR, 'profiles'))
+
+
+class Trace:
+    """Spans recorded while handling one request."""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.start = time.perf_counter()
+        self.spans = []  # [(name, start offset ms, duration ms)]
+        self.threads = {threading.get_ident()}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float):
+        with self._lock:
+            self.spans.append((name, (start - self.start) * 1000, (end - start) * 1000))
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: spans in start order, then the total."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])[:TRACE_MAX_SPANS]
+        entries = [f'{name};dur={duration:.1f}' for name, _, duration in spans]
+        entries.append(f'total;dur={self.elapsed_ms():.1f}')
+        return ', '.join(entries)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+        return {
+            'trace_id': self.trace_id,
+            'duration_ms': round(self.elapsed_ms(), 1),
+            'spans': [{'name': name, 'start_ms': round(offset, 1), 'duration_ms': round(duration, 1)}
+                      for name, offset, duration in spans],
+        }
+
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('trace', default=None)
+
+
+@contextmanager
+def trace_span(name: str):
+    """Record the block as a span of the current request's trace, if any."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, start, time.perf_counter())
+
+
+def _run_in_trace(name: str, func, *args, **kwargs):
+    trace = _current_trace.get()
+    if trace is not None:
+        with trace._lock:
+            trace.threads.add(threading.get_ident())
+    with trace_span(name):
+        return func(*args, **kwargs)
+
+
+def traced_submit(executor: ThreadPoolExecutor, name: str, func, *args, **kwargs) -> Future:
+    """executor.submit() that runs func as span `name` in the caller's context (trace and fairness key)."""
+    return executor.submit(contextvars.copy_context().run, _run_in_trace, name, func, *args, **kwargs)
+
+
+class SamplingProfiler:
+    """Periodically samples the stacks of a trace's threads into collapsed-stack counts."""
+
+    def __init__(self, trace: Trace, interval: float = PROFILE_INTERVAL):
+        self.trace = trace
+        self.interval = interval
+        self.samples: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self.trace._lock:
+                threads = list(self.trace.threads)
+            for thread_id in threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    module = frame.f_globals.get('__name__', '?')
+                    stack.append(f'{module}:{frame.f_code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self) -> Optional[str]:
+        """Stop sampling and write the profile; returns its path."""
+        self._stop.set()
+        self._thread.join()
+        if not self.samples:
+            return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f'{self.trace.trace_id}.folded')
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+def should_profile(headers) -> bool:
+    """Whether this request asked for (or was picked for) profiling."""
+    token = headers.get('X-Profile')
+    if PROFILE_TOKEN and token and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+# Admission control - per-session and per-client token buckets on /chat and
+# /compile, checked before the request body is read, and fair queues in front
+# of pdflatex and Gemini so one busy session can't starve the others. Limits
+# are per worker. ADMISSION_CONFIG names a JSON file (same shape as
+# DEFAULT_ADMISSION, any subset) that is re-read whenever it changes.
+ADMISSION_CONFIG = os.getenv('ADMISSION_CONFIG', '')
+ADMISSION_CONFIG_CHECK_INTERVAL = 2.0
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+# pdflatex runs at once per worker. Sync workers only ever run one, but an
+# async worker would otherwise start one per in-flight request
+MAX_CONCURRENT_COMPILES = int(os.getenv('MAX_CONCURRENT_COMPILES', os.cpu_count() or 2))
+
+DEFAULT_ADMISSION = {
+    # Token buckets: `burst` requests at once, refilled at `per_minute`
+    'limits': {
+        'chat': {'session': {'per_minute': 10, 'burst': 5}, 'client': {'per_minute': 30, 'burst': 10}},
+        'compile': {'session': {'per_minute': 60, 'burst': 10}, 'client': {'per_minute': 120, 'burst': 20}},
+        # Charged per item; burst must cover BATCH_COMPILE_MAX_ITEMS for a full batch to ever pass
+        'compile_batch': {'session': {'per_minute': 60, 'burst': 40}, 'client': {'per_minute': 120, 'burst': 80}},
+    },
+    # A PRO-mode chat costs this many tokens, and this much model-queue share
+    'pro_cost': 3,
+    'queues': {
+        'compile': {'slots': MAX_CONCURRENT_COMPILES, 'max_waiting': 32, 'max_wait_seconds': 30},
+        'model': {'slots': 16, 'max_waiting': 64, 'max_wait_seconds': 60},
+    },
+    # Fair-queue weight per session or client id (default 1); higher gets a bigger share
+    'weights': {},
+}
+
+if TRUSTED_PROXY_COUNT:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+
+class Overloaded(Exception):
+    """A fair queue is full, or a request waited in it too long."""
+
+
+class RateLimiter:
+    """Token buckets keyed by (route, scope, id)."""
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[tuple, list] = {}  # {key: [tokens, updated_at]}
+
+    def take(self, key: tuple, cost: float, per_minute: float, burst: float) -> float:
+        """Take `cost` tokens. Returns 0 if allowed, else seconds until it would be."""
+        rate = per_minute / 60
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[key] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= cost:
+                bucket[0] = tokens - cost
+                return 0.0
+            bucket[0] = tokens
+            return (cost - tokens) / rate if rate > 0 else 60.0
+
+    def _prune(self, now: float):
+        # Buckets idle for a minute have (nearly) refilled; forgetting them is harmless
+        idle = [key for key, (_, updated) in self._buckets.items() if now - updated > 60]
+        for key in idle:
+            del self._buckets[key]
+
+
+class FairScheduler:
+    """A fixed number of slots shared between keys by start-time fair queuing.
+
+    Each request gets a virtual start tag of max(now, its key's last finish),
+    where finishing advances the key by cost / weight; free slots go to the
+    lowest start tag. A key that floods the queue only pushes its own requests
+    back, and a key with weight 2 gets twice the share of a key with weight 1.
+    """
+
+    def __init__(self, name: str, slots: int, max_waiting: int, max_wait_seconds: float):
+        self.name = name
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of [start tag, seq, key]
+        self._finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._seq = 0
+        self._in_use = 0
+        self.configure(slots, max_waiting, max_wait_seconds)
+
+    def configure(self, slots: int, max_waiting: int, max_wait_seconds: float):
+        with self._cond:
+            self.slots = max(1, int(slots))
+            self.max_waiting = int(max_waiting)
+            self.max_wait_seconds = float(max_wait_seconds)
+            self._cond.notify_all()
+
+    def saturated(self) -> bool:
+        """True when a new request would be turned away right now."""
+        return len(self._waiting) >= self.max_waiting
+
+    def acquire(self, key: str, cost: float = 1.0, weight: float = 1.0):
+        """Wait for a slot in fair order; raises Overloaded if the queue is full or the wait too long."""
+        with self._cond:
+            if self._in_use >= self.slots and self.saturated():
+                raise Overloaded(f'{self.name} queue is full')
+            share = cost / max(weight, 0.01)
+            start = max(self._virtual_time, self._finish.get(key, 0.0))
+            self._finish[key] = start + share
+            self._seq += 1
+            ticket = [start, self._seq, key]
+            heapq.heappush(self._waiting, ticket)
+            QUEUE_WAITING.inc(queue=self.name)
+            deadline = time.monotonic() + self.max_wait_seconds
+            try:
+                while self._in_use >= self.slots or self._waiting[0] is not ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                        # Give back the share this request never used
+                        self._finish[key] = max(self._virtual_time, self._finish[key] - share)
+                        self._cond.notify_all()
+                        raise Overloaded(f'timed out waiting for the {self.name} queue')
+                    self._cond.wait(remaining)
+                heapq.heappop(self._waiting)
+            finally:
+                QUEUE_WAITING.dec(queue=self.name)
+            self._in_use += 1
+            self._virtual_time = start
+            if len(self._finish) > 4 * (len(self._waiting) + self.slots) + 100:
+                self._finish = {k: f for k, f in self._finish.items() if f > self._virtual_time}
+            self._cond.notify_all()  # The next ticket may fit a free slot too
+
+    def release(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify_all()
+
+
+RATE_LIMITER = RateLimiter()
+COMPILE_SCHEDULER = FairScheduler('compile', **DEFAULT_ADMISSION['queues']['compile'])
+MODEL_SCHEDULER = FairScheduler('model', **DEFAULT_ADMISSION['queues']['model'])
+
+_admission_config = DEFAULT_ADMISSION
+_admission_config_state = {'checked_at': 0.0, 'mtime': None}
+_admission_config_lock = threading.Lock()
+
+# Session id, else client address, of the request being served; fair queues share by it
+_fairness_key: contextvars.ContextVar = contextvars.ContextVar('fairness_key', default='-')
+
+
+def merge_admission_config(base: dict, override: dict) -> dict:
+    """Recursively overlay `override` on `base` without modifying either."""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merged[key] = merge_admission_config(base[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def get_admission_config() -> dict:
+    """Current limits: the defaults overlaid with ADMISSION_CONFIG, reloaded when the file changes."""
+    global _admission_config
+    if not ADMISSION_CONFIG:
+        return _admission_config
+    now = time.monotonic()
+    if now - _admission_config_state['checked_at'] < ADMISSION_CONFIG_CHECK_INTERVAL:
+        return _admission_config
+    with _admission_config_lock:
+        if now - _admission_config_state['checked_at'] < ADMISSION_CONFIG_CHECK_INTERVAL:
+            return _admission_config
+        _admission_config_state['checked_at'] = now
+        try:
+            mtime = os.stat(ADMISSION_CONFIG).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == _admission_config_state['mtime']:
+            return _admission_config
+        try:
+            override = {}
+            if mtime is not None:
+                with open(ADMISSION_CONFIG) as f:
+                    override = json.load(f)
+            config = merge_admission_config(DEFAULT_ADMISSION, override)
+            for scheduler in (COMPILE_SCHEDULER, MODEL_SCHEDULER):
+                scheduler.configure(**config['queues'][scheduler.name])
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            print(f"Error loading admission config, keeping previous limits: {e}")
+        else:
+            _admission_config = config
+        _admission_config_state['mtime'] = mtime
+    return _admission_config
+
+
+def fairness_weight(key: str) -> float:
+    return float(get_admission_config()['weights'].get(key, 1))
+
+
+def admit(route: str, session_id: Optional[str], client: str, cost: float = 1) -> Optional[Tuple[str, float]]:
+    """Charge a request to its session's and client's buckets.
+
+    Returns None if admitted, else (reason, retry-after seconds).
+    """
+    limits = get_admission_config()['limits'].get(route)
+    if not limits:
+        return None
+    for scope, identity in (('session', session_id), ('client', client)):
+        limit = limits.get(scope)
+        if not identity or not limit:
+            continue
+        wait = RATE_LIMITER.take((route, scope, identity), cost, limit['per_minute'], limit['burst'])
+        if wait:
+            return f'{scope}_rate', wait
+    return None
+
+
 # Store uploaded images per session: {session_id: {filename: temp_path}}
 SESSION_IMAGES: Dict[str, Dict[str, str]] = {}
 
@@ -49,37 +755,739 @@ CHAT_HISTORY_DIR = os.path.join(os.path.dirname(__file__), 'chat_histories')
 os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
 
 
+def safe_chat_id(chat_id: str) -> str:
+    """Sanitize chat_id to prevent directory traversal."""
+    return re.sub(r'[^a-zA-Z0-9_-]', '', chat_id)
+
+
 def get_chat_file_path(chat_id: str) -> str:
     """Get the file path for a specific chat ID."""
-    # Sanitize chat_id to prevent directory traversal
-    safe_id = re.sub(r'[^a-zA-Z0-9_-]', '', chat_id)
-    return os.path.join(CHAT_HISTORY_DIR, f'{safe_id}.json')
+    return os.path.join(CHAT_HISTORY_DIR, f'{safe_chat_id(chat_id)}.json')
+
+
+def get_chat_journal_path(chat_id: str) -> str:
+    """Get the append-only journal path for a specific chat ID."""
+    return os.path.splitext(get_chat_file_path(chat_id))[0] + '.journal'
+
+
+# Each session is stored as a snapshot plus an append-only journal of the
+# changes made since. Saves append only the delta; the journal is folded into
+# a fresh snapshot every HISTORY_COMPACT_EVERY entries.
+HISTORY_COMPACT_EVERY = int(os.getenv('HISTORY_COMPACT_EVERY', 50))
+
+# 'file' keeps each session in chat_histories/{id}.json + {id}.journal;
+# 'sqlite' keeps all sessions in one WAL-mode database shared by all workers
+HISTORY_BACKEND = os.getenv('HISTORY_BACKEND', 'file').lower()
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', os.path.join(CHAT_HISTORY_DIR, 'history.db'))
+
+# Number of hot sessions each worker keeps parsed in memory
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', 64))
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used map.
+
+    With max_bytes, values are bytes and their total length is bounded too.
+    """
+
+    def __init__(self, maxsize: int, max_bytes: Optional[int] = None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _size(self, value) -> int:
+        return len(value) if self.max_bytes is not None else 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
 
+    def put(self, key, value):
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._size(self._data.pop(key))
+            self._data[key] = value
+            self._bytes += self._size(value)
+            while len(self._data) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._bytes -= self._size(self._data.popitem(last=False)[1])
 
-def load_chat_history(chat_id: str = None):
-    """Load chat history from file."""
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._size(self._data.pop(key))
+
+
+def empty_chat_history() -> dict:
+    """Return the state of a session with no history."""
+    return {'messages': [], 'latex': '', 'checkpoints': []}
+
+
+def copy_chat_history(data: dict) -> dict:
+    """Copy a history dict deep enough that callers can't mutate cached lists."""
+    return {k: list(v) if isinstance(v, list) else v for k, v in data.items()}
+
+
+def diff_chat_history(old: dict, new: dict) -> list:
+    """Describe how to turn old into new as a list of journal operations."""
+    if set(old) - set(new):
+        return [{'op': 'reset', 'data': new}]
+    ops = []
+    for key, value in new.items():
+        prev = old.get(key)
+        if key in old and prev == value:
+            continue
+        if (isinstance(value, list) and isinstance(prev, list)
+                and len(value) > len(prev) and value[:len(prev)] == prev):
+            ops.append({'op': 'extend', 'key': key, 'items': value[len(prev):]})
+        else:
+            ops.append({'op': 'set', 'key': key, 'value': value})
+    return ops
+
+
+def apply_history_op(data: dict, entry: dict):
+    """Apply one journal operation to a history dict in place."""
+    op = entry.get('op')
+    if op == 'extend':
+        data[entry['key']] = list(data.get(entry['key']) or []) + entry['items']
+    elif op == 'set':
+        data[entry['key']] = entry['value']
+    elif op == 'reset':
+        data.clear()
+        data.update(entry['data'])
+
+
+def apply_history_ops(data: dict, ops: list) -> dict:
+    """Return a copy of data with journal operations applied."""
+    state = copy_chat_history(data)
+    for op in ops:
+        apply_history_op(state, op)
+    return state
+
+
+def write_snapshot_atomic(file_path: str, data: dict):
+    """Write a JSON snapshot so readers see either the old file or the new one, never half."""
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FileHistoryStore:
+    """Sessions as chat_histories/{id}.json snapshots plus {id}.journal files.
+
+    Both stores hold sessions in their storage form (see encode_chat_history)
+    and expose read/update/list_sessions/delete.
+    """
+
+    def __init__(self):
+        # {file_path: (signature, data, seq, entries)}
+        self._cache = LRUCache(HISTORY_CACHE_SIZE)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    @staticmethod
+    def _signature(file_path: str, journal_path: str) -> tuple:
+        """Cheap fingerprint of a session's files, used to spot writes by other workers."""
+        signature = []
+        for path in (file_path, journal_path):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    @staticmethod
+    def _replay(file_path: str, journal_path: str) -> Tuple[dict, int, int]:
+        """Replay a session from its snapshot and journal. Returns (data, seq, entries)."""
+        data = empty_chat_history()
+        seq = 0
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as f:
+                data = json.load(f)
+            seq = data.pop('journalSeq', 0)
+        entries = 0
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn line from an interrupted write
+                    if entry.get('seq', 0) <= seq:
+                        continue  # Already folded into the snapshot
+                    apply_history_op(data, entry)
+                    seq = entry['seq']
+                    entries += 1
+        return data, seq, entries
+
+    def _cached(self, chat_id: str) -> Tuple[dict, int, int]:
+        """Get (data, seq, entries) for a session, replaying only if its files changed."""
+        file_path, journal_path = get_chat_file_path(chat_id), get_chat_journal_path(chat_id)
+        signature = self._signature(file_path, journal_path)
+        cached = self._cache.get(file_path)
+        if cached and cached[0] == signature:
+            return cached[1:]
+        data, seq, entries = self._replay(file_path, journal_path)
+        self._cache.put(file_path, (signature, data, seq, entries))
+        return data, seq, entries
+
+    @contextmanager
+    def _locked_journal(self, chat_id: str):
+        """Hold the session's write lock (thread and, where supported, process) and its journal."""
+        file_path = get_chat_file_path(chat_id)
+        with self._locks_guard:
+            lock = self._locks.setdefault(file_path, threading.Lock())
+        with lock, open(get_chat_journal_path(chat_id), 'a+b') as journal:
+            if fcntl:
+                fcntl.flock(journal, fcntl.LOCK_EX)
+            try:
+                yield journal
+            finally:
+                if fcntl:
+                    fcntl.flock(journal, fcntl.LOCK_UN)
+
+    def read(self, chat_id: str) -> dict:
+        """Get a session's stored state. Callers must not mutate it."""
+        return self._cached(chat_id)[0]
+
+    def update(self, chat_id: str, make_ops):
+        """Journal the operations make_ops(current_state) returns, compacting when due."""
+        file_path, journal_path = get_chat_file_path(chat_id), get_chat_journal_path(chat_id)
+        with self._locked_journal(chat_id) as journal:
+            old, seq, entries = self._cached(chat_id)
+            ops = make_ops(old)
+            if not ops:
+                return
+            
+            lines = []
+            for op in ops:
+                seq += 1
+                lines.append(json.dumps({'seq': seq, **op}))
+            payload = ('\n'.join(lines) + '\n').encode('utf-8')
+            
+            # Start on a fresh line if a previous write was cut short
+            journal.seek(0, os.SEEK_END)
+            if journal.tell() > 0:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    payload = b'\n' + payload
+            journal.write(payload)
+            journal.flush()
+            entries += len(ops)
+            
+            state = apply_history_ops(old, ops)
+            if entries >= HISTORY_COMPACT_EVERY:
+                # Snapshot first, then truncate; journalSeq lets a reload skip
+                # entries that were already folded in if we die in between
+                write_snapshot_atomic(file_path, {**state, 'journalSeq': seq})
+                journal.truncate(0)
+                journal.flush()
+                entries = 0
+            
+            self._cache.put(file_path, (self._signature(file_path, journal_path), state, seq, entries))
+
+    def list_sessions(self) -> list:
+        """List stored sessions as [{'id', 'updated_at'}], most recent first."""
+        updated: Dict[str, float] = {}
+        for entry in os.scandir(CHAT_HISTORY_DIR):
+            chat_id, ext = os.path.splitext(entry.name)
+            if ext in ('.json', '.journal') and entry.is_file():
+                updated[chat_id] = max(updated.get(chat_id, 0), entry.stat().st_mtime)
+        return [{'id': k, 'updated_at': v} for k, v in sorted(updated.items(), key=lambda kv: -kv[1])]
+
+    def delete(self, chat_id: str):
+        """Remove a session entirely."""
+        with self._locked_journal(chat_id):
+            for path in (get_chat_file_path(chat_id), get_chat_journal_path(chat_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._cache.pop(get_chat_file_path(chat_id))
+
+
+class SQLiteHistoryStore:
+    """Sessions in one SQLite database (WAL mode), shared safely by gunicorn workers.
+
+    Uses the same snapshot + journal layout as FileHistoryStore, as two tables.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS history_sessions (
+            session_id TEXT PRIMARY KEY,
+            snapshot TEXT NOT NULL,
+            snapshot_seq INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_sessions_updated_at ON history_sessions (updated_at);
+        CREATE TABLE IF NOT EXISTS history_journal (
+            session_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        # {session_id: (seq, data, snapshot_seq)}
+        self._cache = LRUCache(HISTORY_CACHE_SIZE)
+        self._connect().executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread, reopened after a fork (gunicorn --preload)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _cached(self, conn: sqlite3.Connection, chat_id: str) -> Tuple[dict, int, int]:
+        """Get (data, seq, snapshot_seq), replaying only if another writer moved seq."""
+        row = conn.execute('SELECT seq FROM history_sessions WHERE session_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            self._cache.pop(chat_id)
+            return empty_chat_history(), 0, 0
+        cached = self._cache.get(chat_id)
+        if cached and cached[0] == row[0]:
+            return cached[1], cached[0], cached[2]
+        snapshot, snapshot_seq = conn.execute(
+            'SELECT snapshot, snapshot_seq FROM history_sessions WHERE session_id = ?', (chat_id,)
+        ).fetchone()
+        data = json.loads(snapshot)
+        seq = snapshot_seq
+        for seq, op in conn.execute(
+            'SELECT seq, op FROM history_journal WHERE session_id = ? AND seq > ? ORDER BY seq',
+            (chat_id, snapshot_seq)
+        ):
+            apply_history_op(data, json.loads(op))
+        self._cache.put(chat_id, (seq, data, snapshot_seq))
+        return data, seq, snapshot_seq
+
+    def read(self, chat_id: str) -> dict:
+        """Get a session's stored state. Callers must not mutate it."""
+        return self._cached(self._connect(), safe_chat_id(chat_id))[0]
+
+    def update(self, chat_id: str, make_ops, updated_at: Optional[float] = None):
+        """Journal the operations make_ops(current_state) returns, compacting when due.
+
+        updated_at defaults to now; imports pass the source's own time.
+        """
+        chat_id = safe_chat_id(chat_id)
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old, seq, snapshot_seq = self._cached(conn, chat_id)
+            ops = make_ops(old)
+            if not ops:
+                conn.execute('ROLLBACK')
+                return
+            conn.executemany(
+                'INSERT INTO history_journal (session_id, seq, op) VALUES (?, ?, ?)',
+                [(chat_id, seq + i, json.dumps(op)) for i, op in enumerate(ops, 1)]
+            )
+            seq += len(ops)
+            conn.execute(
+                'INSERT INTO history_sessions (session_id, snapshot, snapshot_seq, seq, updated_at) '
+                'VALUES (?, ?, 0, ?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET seq = excluded.seq, updated_at = excluded.updated_at',
+                (chat_id, json.dumps(empty_chat_history()), seq, time.time() if updated_at is None else updated_at)
+            )
+            state = apply_history_ops(old, ops)
+            if seq - snapshot_seq >= HISTORY_COMPACT_EVERY:
+                conn.execute(
+                    'UPDATE history_sessions SET snapshot = ?, snapshot_seq = ? WHERE session_id = ?',
+                    (json.dumps(state), seq, chat_id)
+                )
+                conn.execute('DELETE FROM history_journal WHERE session_id = ? AND seq <= ?', (chat_id, seq))
+                snapshot_seq = seq
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._cache.put(chat_id, (seq, state, snapshot_seq))
+
+    def list_sessions(self) -> list:
+        """List stored sessions as [{'id', 'updated_at'}], most recent first."""
+        rows = self._connect().execute(
+            'SELECT session_id, updated_at FROM history_sessions ORDER BY updated_at DESC'
+        )
+        return [{'id': session_id, 'updated_at': updated_at} for session_id, updated_at in rows]
+
+    def delete(self, chat_id: str):
+        """Remove a session entirely."""
+        chat_id = safe_chat_id(chat_id)
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM history_journal WHERE session_id = ?', (chat_id,))
+            conn.execute('DELETE FROM history_sessions WHERE session_id = ?', (chat_id,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._cache.pop(chat_id)
+
+
+# Checkpoints are near-identical copies of the resume, so on disk each one is
+# a zlib-compressed line diff against the previous checkpoint, with a full
+# keyframe every CHECKPOINT_KEYFRAME_EVERY entries to bound replay length.
+# Messages point at their checkpoint by content hash instead of repeating it.
+CHECKPOINT_KEYFRAME_EVERY = 10
+CHECKPOINT_STORAGE_KEYS = ('latexHash', 'latexFull', 'latexDelta')
+
+
+def latex_digest(latex: str) -> str:
+    """Short content hash used to match checkpoints without materializing them."""
+    return hashlib.sha1(latex.encode('utf-8')).hexdigest()[:16]
+
+
+def _pack(obj) -> str:
+    return base64.b64encode(zlib.compress(json.dumps(obj, separators=(',', ':')).encode('utf-8'))).decode('ascii')
+
+
+def _unpack(blob: str):
+    return json.loads(zlib.decompress(base64.b64decode(blob)))
+
+
+def diff_latex(base: str, latex: str) -> list:
+    """Line diff of latex against base. [start, end] copies base lines; strings are inserted."""
+    base_lines = base.splitlines(keepends=True)
+    lines = latex.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(lines[j1:j2]))
+    return ops
+
+
+def patch_latex(base: str, ops: list) -> str:
+    """Rebuild a document from its base and the output of diff_latex."""
+    base_lines = base.splitlines(keepends=True)
+    return ''.join(''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+def encode_checkpoint(checkpoint: dict, index: int, prev_latex: Optional[str]) -> dict:
+    """Encode one checkpoint as a keyframe or a delta against the previous checkpoint."""
+    latex = checkpoint['latex']
+    encoded = {k: v for k, v in checkpoint.items() if k != 'latex'}
+    encoded['latexHash'] = latex_digest(latex)
+    keyframe = _pack(latex)
+    if prev_latex is not None and index % CHECKPOINT_KEYFRAME_EVERY:
+        delta = _pack(diff_latex(prev_latex, latex))
+        if len(delta) < len(keyframe):
+            encoded['latexDelta'] = delta
+            return encoded
+    encoded['latexFull'] = keyframe
+    return encoded
+
+
+def checkpoint_latex(checkpoints: list, index: int, memo: Optional[dict] = None) -> Optional[str]:
+    """Materialize the LaTeX of one stored checkpoint (walks back to its keyframe)."""
+    memo = {} if memo is None else memo
+    if index in memo:
+        return memo[index]
+    checkpoint = checkpoints[index]
+    if not isinstance(checkpoint, dict):
+        return None
+    if 'latexDelta' in checkpoint:
+        base = checkpoint_latex(checkpoints, index - 1, memo) or ''
+        latex = patch_latex(base, _unpack(checkpoint['latexDelta']))
+    elif 'latexFull' in checkpoint:
+        latex = _unpack(checkpoint['latexFull'])
+    else:
+        latex = checkpoint.get('latex')  # Stored before compression was added
+    memo[index] = latex
+    return latex
+
+
+def _checkpoint_fields(checkpoint: dict) -> dict:
+    return {k: v for k, v in checkpoint.items() if k != 'latex' and k not in CHECKPOINT_STORAGE_KEYS}
+
+
+def encode_checkpoints(checkpoints: list, old: list) -> list:
+    """Encode checkpoints for storage, reusing old encoded entries for the unchanged prefix.
+
+    Checkpoints sent without 'latex' (lazy stubs) are matched to stored ones by id.
+    """
+    old_index_by_id = {cp.get('id'): i for i, cp in enumerate(old) if isinstance(cp, dict)}
+    old_memo = {}
+    encoded = []
+    reusing = True
+    prev = None  # ('text', latex) or ('old', index) for the previous checkpoint
+
+    def prev_latex():
+        if prev is None:
+            return None
+        return prev[1] if prev[0] == 'text' else checkpoint_latex(old, prev[1], old_memo)
+
+    for i, checkpoint in enumerate(checkpoints):
+        if not isinstance(checkpoint, dict):
+            reusing = False
+            encoded.append(checkpoint)
+            prev = None
+            continue
+        latex = checkpoint.get('latex')
+        old_match = old[i] if i < len(old) and isinstance(old[i], dict) else None
+        same_fields = old_match is not None and _checkpoint_fields(old_match) == _checkpoint_fields(checkpoint)
+        if reusing and same_fields and 'latexHash' in old_match and (
+                latex is None or old_match['latexHash'] == latex_digest(latex)):
+            encoded.append(old_match)
+            prev = ('old', i) if latex is None else ('text', latex)
+            continue
+        reusing = False
+        if latex is None and checkpoint.get('id') in old_index_by_id:
+            latex = checkpoint_latex(old, old_index_by_id[checkpoint['id']], old_memo)
+            checkpoint = {**checkpoint, 'latex': latex}
+        if not isinstance(latex, str):
+            encoded.append(checkpoint)
+            prev = None
+            continue
+        encoded.append(encode_checkpoint(checkpoint, i, prev_latex()))
+        prev = ('text', latex)
+    return encoded
+
+
+def _checkpoint_hashes(checkpoints: list) -> Dict:
+    """Map checkpoint id -> content hash for encoded checkpoints."""
+    return {cp.get('id'): cp['latexHash'] for cp in checkpoints if isinstance(cp, dict) and 'latexHash' in cp}
+
+
+def encode_message(message, hash_by_id: Dict):
+    """Swap a message's embedded checkpoint copy for a reference to the stored checkpoint."""
+    ref = message.get('checkpoint') if isinstance(message, dict) else None
+    if isinstance(ref, dict) and 'latexRef' not in ref:
+        latex = ref.get('latex')
+        digest = latex_digest(latex) if isinstance(latex, str) else hash_by_id.get(ref.get('id'))
+        if digest is not None and digest in hash_by_id.values():
+            return {**message, 'checkpoint': {**_checkpoint_fields(ref), 'latexRef': digest}}
+    return message
+
+
+def encode_chat_history(data: dict, old: dict) -> dict:
+    """Convert a client-facing history dict into its storage form."""
+    encoded = copy_chat_history(data)
+    checkpoints = data.get('checkpoints')
+    if not isinstance(checkpoints, list):
+        return encoded
+    encoded['checkpoints'] = encode_checkpoints(checkpoints, old.get('checkpoints') or [])
+    hash_by_id = _checkpoint_hashes(encoded['checkpoints'])
+    if 'messages' in data:
+        encoded['messages'] = [encode_message(m, hash_by_id) for m in data['messages'] or []]
+    return encoded
+
+
+def decode_chat_history(stored: dict, lazy_checkpoints: bool = False, fields=None) -> dict:
+    """Convert stored history back to the client-facing form.
+
+    With lazy_checkpoints, checkpoints come back as stubs without 'latex' and
+    are materialized one at a time through load_checkpoint_latex. fields
+    limits which top-level keys are returned (and decoded).
+    """
+    data = copy_chat_history({k: v for k, v in stored.items() if fields is None or k in fields})
+    checkpoints = stored.get('checkpoints')
+    if not isinstance(checkpoints, list):
+        return data
+    memo = {}
+    index_by_hash = {cp['latexHash']: i for i, cp in enumerate(checkpoints)
+                     if isinstance(cp, dict) and 'latexHash' in cp}
+
+    def materialize(ref: dict, index: Optional[int]) -> dict:
+        if lazy_checkpoints or index is None:
+            return ref
+        return {**ref, 'latex': checkpoint_latex(checkpoints, index, memo)}
+
+    if 'checkpoints' in data:
+        data['checkpoints'] = [
+            materialize(_checkpoint_fields(cp), i) if isinstance(cp, dict) and 'latexHash' in cp else cp
+            for i, cp in enumerate(checkpoints)
+        ]
+    if isinstance(data.get('messages'), list):
+        messages = []
+        for message in data['messages']:
+            ref = message.get('checkpoint') if isinstance(message, dict) else None
+            if isinstance(ref, dict) and 'latexRef' in ref:
+                plain = {k: v for k, v in ref.items() if k != 'latexRef'}
+                message = {**message, 'checkpoint': materialize(plain, index_by_hash.get(ref['latexRef']))}
+            messages.append(message)
+        data['messages'] = messages
+    return data
+
+
+def history_patch_ops(old: dict, patch_ops: list) -> list:
+    """Translate client PATCH operations into journal operations on the stored state.
+
+    Supported: {'op': 'append_message', 'message': {...}},
+    {'op': 'set_latex', 'latex': '...'} and
+    {'op': 'add_checkpoint', 'checkpoint': {'id': ..., 'latex': '...'}}.
+    Operations apply in order, so a message can reference a checkpoint added
+    earlier in the same batch.
+    """
+    state = copy_chat_history(old)
+    ops = []
+    for patch in patch_ops:
+        kind = patch.get('op') if isinstance(patch, dict) else None
+        if kind == 'append_message':
+            if not isinstance(patch.get('message'), dict):
+                raise ValueError('append_message needs a message object')
+            message = encode_message(patch['message'], _checkpoint_hashes(state.get('checkpoints') or []))
+            op = {'op': 'extend', 'key': 'messages', 'items': [message]}
+        elif kind == 'set_latex':
+            if not isinstance(patch.get('latex'), str):
+                raise ValueError('set_latex needs a latex string')
+            op = {'op': 'set', 'key': 'latex', 'value': patch['latex']}
+        elif kind == 'add_checkpoint':
+            checkpoint = patch.get('checkpoint')
+            if not isinstance(checkpoint, dict) or not isinstance(checkpoint.get('latex'), str):
+                raise ValueError('add_checkpoint needs a checkpoint with latex')
+            checkpoints = state.get('checkpoints') or []
+            prev_latex = checkpoint_latex(checkpoints, len(checkpoints) - 1) if checkpoints else None
+            op = {'op': 'extend', 'key': 'checkpoints', 'items': [encode_checkpoint(checkpoint, len(checkpoints), prev_latex)]}
+        else:
+            raise ValueError(f'unknown operation {kind!r}')
+        apply_history_op(state, op)
+        ops.append(op)
+    return ops
+
+
+_history_store = None
+_history_store_lock = threading.Lock()
+
+
+def get_history_store():
+    """Get the configured history store, creating it on first use."""
+    global _history_store
+    if _history_store is None:
+        with _history_store_lock:
+            if _history_store is None:
+                if HISTORY_BACKEND == 'sqlite':
+                    _history_store = SQLiteHistoryStore(HISTORY_DB_PATH)
+                else:
+                    _history_store = FileHistoryStore()
+    return _history_store
+
+
+def load_chat_history(chat_id: str = None, lazy_checkpoints: bool = False, fields=None,
+                      limit: Optional[int] = None, before: Optional[int] = None):
+    """Load chat history for a session.
+
+    limit/before page through messages: the latest `limit` messages before
+    index `before` (default: the end). Paged results also carry
+    messageOffset and messageCount.
+    """
     try:
         if chat_id:
-            file_path = get_chat_file_path(chat_id)
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    return json.load(f)
+            with HISTORY_SECONDS.time(op='read', backend=HISTORY_BACKEND), trace_span('history.read'):
+                stored = get_history_store().read(chat_id)
+            page = {}
+            if limit is not None or before is not None:
+                messages = stored.get('messages') or []
+                end = len(messages) if before is None else max(0, min(before, len(messages)))
+                start = 0 if limit is None else max(0, end - max(limit, 0))
+                stored = {**stored, 'messages': messages[start:end]}
+                page = {'messageOffset': start, 'messageCount': len(messages)}
+            return {**decode_chat_history(stored, lazy_checkpoints, fields), **page}
     except Exception:
-        pass
-    return {'messages': [], 'latex': '', 'checkpoints': []}
+        HISTORY_ERRORS.inc(op='read', backend=HISTORY_BACKEND)
+    return empty_chat_history()
+
+
+def load_checkpoint_latex(chat_id: str, checkpoint_id) -> Optional[str]:
+    """Materialize a single checkpoint's LaTeX, e.g. when the user restores it."""
+    checkpoints = get_history_store().read(chat_id).get('checkpoints') or []
+    for index in range(len(checkpoints) - 1, -1, -1):
+        checkpoint = checkpoints[index]
+        if isinstance(checkpoint, dict) and str(checkpoint.get('id')) == str(checkpoint_id):
+            return checkpoint_latex(checkpoints, index)
+    return None
 
 
 def save_chat_history(data, chat_id: str = None):
-    """Save chat history to file."""
+    """Save chat history by journaling what changed since the last save."""
     if not chat_id:
         return  # Don't save without a chat ID
     try:
-        file_path = get_chat_file_path(chat_id)
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=2)
+        with HISTORY_SECONDS.time(op='write', backend=HISTORY_BACKEND), trace_span('history.write'):
+            get_history_store().update(chat_id, lambda old: diff_chat_history(old, encode_chat_history(data, old)))
     except Exception as e:
+        HISTORY_ERRORS.inc(op='write', backend=HISTORY_BACKEND)
         print(f"Error saving chat history: {e}")
 
+
+def expire_chat_histories(max_age_seconds: float) -> int:
+    """Delete sessions not updated within max_age_seconds. Returns how many were removed."""
+    store = get_history_store()
+    cutoff = time.time() - max_age_seconds
+    expired = [s['id'] for s in store.list_sessions() if s['updated_at'] < cutoff]
+    for chat_id in expired:
+        store.delete(chat_id)
+    return len(expired)
+
+
+def import_json_histories(store, directory: str = None, overwrite: bool = False) -> Tuple[int, int]:
+    """Copy file-backend sessions from directory into store. Returns (imported, skipped)."""
+    directory = directory or CHAT_HISTORY_DIR
+    existing = {s['id'] for s in store.list_sessions()}
+    # Until its first compaction a session is only a .journal, without a .json
+    chat_ids = set()
+    for name in os.listdir(directory):
+        chat_id, ext = os.path.splitext(name)
+        if ext in ('.json', '.journal') and chat_id == safe_chat_id(chat_id):
+            chat_ids.add(chat_id)
+    imported = skipped = 0
+    for chat_id in sorted(chat_ids):
+        if chat_id in existing and not overwrite:
+            skipped += 1
+            continue
+        paths = [os.path.join(directory, f'{chat_id}.json'), os.path.join(directory, f'{chat_id}.journal')]
+        data, _, _ = FileHistoryStore._replay(*paths)
+        data = decode_chat_history(data)
+        # Keep the session's age, so expire-history still sees how long it has been idle
+        updated_at = max(os.path.getmtime(path) for path in paths if os.path.exists(path))
+        store.update(chat_id, lambda old: diff_chat_history(old, encode_chat_history(data, old)), updated_at=updated_at)
+        imported += 1
+    return imported, skipped
+
+
+@app.cli.command('import-history')
+@click.option('--source', default=None, help='Directory of {id}.json/{id}.journal sessions (default: chat_histories/).')
+@click.option('--overwrite', is_flag=True, help='Replace sessions that already exist in the database.')
+def import_history_command(source, overwrite):
+    """Import JSON chat histories into the SQLite history database."""
+    store = SQLiteHistoryStore(HISTORY_DB_PATH)
+    imported, skipped = import_json_histories(store, source, overwrite)
+    click.echo(f'Imported {imported} session(s) into {HISTORY_DB_PATH}, skipped {skipped} existing.')
+
+
+@app.cli.command('expire-history')
+@click.option('--days', default=30, show_default=True, help='Delete sessions idle for longer than this.')
+def expire_history_command(days):
+    """Delete chat histories that haven't been updated in a while."""
+    removed = expire_chat_histories(days * 86400)
+    click.echo(f'Removed {removed} session(s) from the {HISTORY_BACKEND} history store.')
+
+
 SAMPLE_TEMPLATES = {
     "minimal": r"""\documentclass[11pt,a4paper]{article}
 \usepackage[utf8]{inputenc}
@@ -272,6 +1680,27 @@ IMPORTANT: Always define ALL colors at the top using \\definecolor before using
 When user provides an image filename, include it with \\includegraphics[width=Xcm]{filename}."""
 
 
+def cache_tool_path(find):
+    """Remember a tool's path once found, so each call doesn't re-probe the filesystem.
+
+    A missing tool is looked up again on the next call, so installing it
+    doesn't need a restart.
+    """
+    found = []
+
+    @functools.wraps(find)
+    def wrapper() -> Optional[str]:
+        if not found:
+            path = find()
+            if path is None:
+                return None
+            found.append(path)
+        return found[0]
+
+    return wrapper
+
+
+@cache_tool_path
 def find_pdflatex() -> Optional[str]:
     """Find pdflatex executable."""
     if shutil.which('pdflatex'):
@@ -292,9 +1721,45 @@ def find_pdflatex() -> Optional[str]:
     return None
 
 
-def compile_latex(latex_code: str, session_id: str = None) -> Tuple[bool, str, Optional[str]]:
-    """Compile LaTeX code to PDF. Returns (success, message, pdf_path)."""
-    
+# Returned when pdflatex could not load the preamble format given with fmt_path
+FORMAT_LOAD_FAILED = "The preamble format could not be loaded."
+# pdflatex's complaints about a missing, incompatible or corrupt format
+FORMAT_ERROR_RE = re.compile(r"format file|\.fmt'? (?:was written|made by)", re.I)
+
+
+def compile_latex(latex_code: str, session_id: str = None, fmt_path: Optional[str] = None,
+                  aux: Optional[bytes] = None) -> Tuple[bool, str, Optional[str]]:
+    """Compile LaTeX code to PDF. Returns (success, message, pdf_path).
+
+    fmt_path: a format with the document's preamble already loaded (see
+    get_preamble_format). aux: the .aux of an earlier compile of the same
+    document; the second pass is skipped if the first one leaves it unchanged.
+    """
+    key = _fairness_key.get()
+    try:
+        with trace_span('compile.wait'):
+            COMPILE_SCHEDULER.acquire(key, weight=fairness_weight(key))
+    except Overloaded:
+        ADMISSION_REJECTED.inc(route='compile', reason='queue')
+        return False, "The server is busy compiling other documents. Please try again in a moment.", None
+    start = time.perf_counter()
+    try:
+        with COMPILES_IN_PROGRESS.track_in_progress(), trace_span('compile'):
+            success, message, pdf_path = _compile_latex(latex_code, session_id, fmt_path, aux)
+    finally:
+        COMPILE_SCHEDULER.release()
+    if success:
+        result = 'success'
+    elif message == "Compilation timed out.":
+        result = 'timeout'
+    else:
+        result = 'failure'
+    COMPILE_SECONDS.observe(time.perf_counter() - start, result=result)
+    return success, message, pdf_path
+
+
+def _compile_latex(latex_code: str, session_id: str = None, fmt_path: Optional[str] = None,
+                   aux: Optional[bytes] = None) -> Tuple[bool, str, Optional[str]]:
     pdflatex_path = find_pdflatex()
     if not pdflatex_path:
         return False, "pdflatex not found. Please install LaTeX:\n• macOS: brew install --cask mactex-no-gui\n• Ubuntu: sudo apt install texlive-full\n• Windows: Install MiKTeX from miktex.org", None
@@ -305,6 +1770,14 @@ def compile_latex(latex_code: str, session_id: str = None) -> Tuple[bool, str, O
     
     tex_file = os.path.join(job_dir, 'resume.tex')
     pdf_file = os.path.join(job_dir, 'resume.pdf')
+    aux_file = os.path.join(job_dir, 'resume.aux')
+    command = [pdflatex_path, '-synctex=1', '-interaction=nonstopmode', '-output-directory', job_dir]
+    if fmt_path:
+        # The format already holds the preamble; comment it out line for line
+        # so SyncTeX line numbers still match the editor
+        preamble, body = split_preamble(latex_code)
+        latex_code = '%\n' * preamble.count('\n') + body
+        command.append(f'-fmt={fmt_path}')
     
     try:
         # Copy session images to the job directory for compilation
@@ -316,19 +1789,28 @@ def compile_latex(latex_code: str, session_id: str = None) -> Tuple[bool, str, O
         
         with open(tex_file, 'w', encoding='utf-8') as f:
             f.write(latex_code)
+        if aux is not None:
+            with open(aux_file, 'wb') as f:
+                f.write(aux)
         
-        for _ in range(2):
-            result = subprocess.run(
-                [pdflatex_path, '-synctex=1', '-interaction=nonstopmode', '-output-directory', job_dir, tex_file],
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
+        for run in ('1', '2'):
+            with PDFLATEX_PASS_SECONDS.time(run=run), trace_span(f'pdflatex{run}'):
+                result = subprocess.run(
+                    command + [tex_file],
+                    capture_output=True,
+                    text=True,
+                    timeout=60
+                )
+            if aux is not None and read_bytes(aux_file) == aux:
+                break  # References already matched the earlier compile's; a second pass changes nothing
         
         if os.path.exists(pdf_file):
             return True, "PDF generated successfully!", pdf_file
         else:
             log_file = os.path.join(job_dir, 'resume.log')
+            # pdflatex only opens the log once the format is loaded
+            if fmt_path and (not os.path.exists(log_file) or FORMAT_ERROR_RE.search(result.stdout or '')):
+                return False, FORMAT_LOAD_FAILED, None
             error_msg = "Compilation failed."
             if os.path.exists(log_file):
                 with open(log_file, 'r', encoding='utf-8', errors='ignore') as f:
@@ -345,6 +1827,239 @@ def compile_latex(latex_code: str, session_id: str = None) -> Tuple[bool, str, O
         return False, f"Error: {str(e)}", None
 
 
+# Incremental compiles - when a session recompiles, the preamble is loaded
+# from a pdflatex format dumped once per reused preamble (package loading is
+# most of a resume's compile time), and the previous compile's .aux is reused so
+# edits that don't move references need one pass instead of two. An unchanged
+# document reuses the previous PDF. Anything else is a full compile.
+INCREMENTAL_COMPILE = os.getenv('INCREMENTAL_COMPILE', '').lower() in ('1', 'true', 'yes')
+INCREMENTAL_SESSIONS = int(os.getenv('INCREMENTAL_SESSIONS', 256))
+FORMAT_DIR = os.path.join(TEMP_DIR, 'formats')
+
+BEGIN_DOCUMENT_RE = re.compile(r'^[^%\n]*?(\\begin\s*\{document\})', re.M)
+SECTION_RE = re.compile(r'^[ \t]*\\section\*?(?:\[[^\]\n]*\])?\{', re.M)
+
+# Formats are built in the background, one at a time, and only for a preamble
+# compiled at least twice (Gemini rewrites preambles often). Each build takes
+# a compile slot like any other pdflatex run: {preamble digest: Future, or
+# None for a preamble seen once}
+FORMAT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='latex-format')
+_format_builds = LRUCache(INCREMENTAL_SESSIONS)
+_format_builds_lock = threading.Lock()
+_NOT_SEEN = object()
+
+# {session_id: what its last successful compile left behind}
+_incremental_states = LRUCache(INCREMENTAL_SESSIONS)
+# Moving average of full compile time, the baseline for sessions without one
+_full_compile_ms = {'average': None}
+
+
+def read_bytes(path: str) -> Optional[bytes]:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def split_preamble(latex_code: str) -> Tuple[str, str]:
+    """Split at \\begin{document} into (preamble, body). The preamble is '' if there is none."""
+    match = BEGIN_DOCUMENT_RE.search(latex_code)
+    if not match:
+        return '', latex_code
+    return latex_code[:match.start(1)], latex_code[match.start(1):]
+
+
+def _section_title(text: str) -> str:
+    """Title of a \\section whose opening brace was just consumed."""
+    depth = 0
+    for i, char in enumerate(text[:200]):
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            if depth == 0:
+                return ' '.join(text[:i].split())
+            depth -= 1
+    return ' '.join(text.split('\n', 1)[0].split())
+
+
+def section_hashes(body: str) -> Dict[str, str]:
+    """{section title: content hash} of a document body; text before the first \\section is '(top)'."""
+    matches = list(SECTION_RE.finditer(body))
+    bounds = [0] + [m.start() for m in matches] + [len(body)]
+    titles = ['(top)'] + [_section_title(body[m.end():]) for m in matches]
+    sections = {}
+    for title, start, end in zip(titles, bounds, bounds[1:]):
+        key = title
+        n = 2
+        while key in sections:  # Repeated titles stay distinct
+            key = f'{title} ({n})'
+            n += 1
+        sections[key] = hashlib.sha256(body[start:end].encode('utf-8')).hexdigest()
+    return sections
+
+
+def build_format(preamble: str, fmt_dir: str) -> Optional[str]:
+    """Dump a preamble into a pdflatex format. Returns its path without .fmt, or None if it failed."""
+    pdflatex_path = find_pdflatex()
+    if not pdflatex_path:
+        return None
+    fmt_path = os.path.join(fmt_dir, 'preamble')
+    if os.path.exists(fmt_path + '.fmt'):
+        return fmt_path  # Built by another worker
+    # Build next to the final directory and rename it into place, so other
+    # workers never load a half-written format
+    key = _fairness_key.get()
+    COMPILE_SCHEDULER.acquire(key, weight=fairness_weight(key))  # Overloaded: not built, retried later
+    build_dir = tempfile.mkdtemp(prefix='build-', dir=os.path.dirname(fmt_dir))
+    try:
+        source = os.path.join(build_dir, 'preamble.tex')
+        with open(source, 'w', encoding='utf-8') as f:
+            f.write(preamble + '\n\\dump\n')
+        subprocess.run(
+            [pdflatex_path, '-ini', '-interaction=nonstopmode', '-jobname=preamble',
+             '-output-directory', build_dir, '&pdflatex', source],
+            capture_output=True,
+            text=True,
+            timeout=120
+        )
+        if not os.path.exists(os.path.join(build_dir, 'preamble.fmt')):
+            return None
+        try:
+            os.rename(build_dir, fmt_dir)
+        except OSError:
+            pass  # Another worker got there first; theirs is as good
+        return fmt_path if os.path.exists(fmt_path + '.fmt') else None
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"Error building LaTeX format: {e}")
+        return None
+    finally:
+        COMPILE_SCHEDULER.release()
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def format_digest(preamble: str) -> str:
+    return hashlib.sha256(preamble.encode('utf-8')).hexdigest()[:24]
+
+
+def get_preamble_format(preamble: str) -> Optional[str]:
+    """The preamble's format if it is ready; otherwise maybe start building it and return None."""
+    digest = format_digest(preamble)
+    fmt_dir = os.path.join(FORMAT_DIR, digest)
+    with _format_builds_lock:
+        future = _format_builds.get(digest, _NOT_SEEN)
+        if future is _NOT_SEEN or future is None:
+            if os.path.exists(os.path.join(fmt_dir, 'preamble.fmt')):
+                _format_builds.put(digest, completed_future(os.path.join(fmt_dir, 'preamble')))
+                return os.path.join(fmt_dir, 'preamble')
+            if future is _NOT_SEEN:
+                _format_builds.put(digest, None)  # Built if this preamble comes back
+                return None
+            os.makedirs(FORMAT_DIR, exist_ok=True)
+            _format_builds.put(digest, traced_submit(FORMAT_EXECUTOR, 'format.build', build_format, preamble, fmt_dir))
+            return None
+    if not future.done():
+        return None
+    if isinstance(future.exception(), Overloaded):
+        _format_builds.put(digest, None)  # The compile queue was full; build on the next compile
+        return None
+    return future.result()  # None for a preamble that can't be dumped; not retried
+
+
+def discard_preamble_format(preamble: str):
+    """Stop using a format pdflatex failed to load, here and in other workers."""
+    digest = format_digest(preamble)
+    _format_builds.put(digest, completed_future(None))
+    shutil.rmtree(os.path.join(FORMAT_DIR, digest), ignore_errors=True)
+
+
+def completed_future(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def compile_latex_incremental(latex_code: str, session_id: str) -> Tuple[bool, str, Optional[str], dict]:
+    """Compile, reusing what the session's last compile left behind where possible.
+
+    Returns (success, message, pdf_path, report), where report gives the
+    mode used (unchanged, incremental, full or fallback), the sections changed
+    since the last compile and the time saved against a full compile.
+    """
+    start = time.perf_counter()
+    preamble, body = split_preamble(latex_code)
+    preamble_digest = hashlib.sha256(preamble.encode('utf-8')).hexdigest()
+    sections = section_hashes(body)
+    images = sorted((name, os.path.getmtime(path)) for name, path in SESSION_IMAGES.get(session_id, {}).items()
+                    if os.path.exists(path))
+    inputs = hashlib.sha256(json.dumps([latex_code, images]).encode('utf-8')).hexdigest()
+
+    state = _incremental_states.get(session_id) or {}
+    previous = state.get('sections', {})
+    report = {
+        'changed_sections': [title for title, digest in sections.items() if previous.get(title) != digest],
+        'removed_sections': [title for title in previous if title not in sections],
+        'preamble_changed': bool(state) and state.get('preamble') != preamble_digest,
+    }
+
+    passes = 0
+    if state.get('inputs') == inputs and state.get('pdf_path') and os.path.exists(state['pdf_path']):
+        mode = 'unchanged'
+        success, message, pdf_path = True, "PDF generated successfully!", state['pdf_path']
+    else:
+        fmt_path = get_preamble_format(preamble) if preamble else None
+        aux = state.get('aux') if state.get('preamble') == preamble_digest else None
+        mode = 'full'
+        if fmt_path:
+            mode = 'incremental'
+            success, message, pdf_path = compile_latex(latex_code, session_id, fmt_path=fmt_path, aux=aux)
+            if success:
+                new_aux = read_bytes(os.path.join(os.path.dirname(pdf_path), 'resume.aux'))
+                passes = 1 if aux is not None and new_aux == aux else 2
+            elif message == FORMAT_LOAD_FAILED:
+                mode = 'fallback'  # e.g. a format dumped by another pdflatex version
+                discard_preamble_format(preamble)
+            else:
+                passes = 2  # An error in the document itself; a full compile would hit it too
+        if mode != 'incremental':
+            full_start = time.perf_counter()
+            success, message, pdf_path = compile_latex(latex_code, session_id)
+            passes = 2
+            if success:
+                full_ms = (time.perf_counter() - full_start) * 1000
+                state['full_ms'] = full_ms
+                average = _full_compile_ms['average']
+                _full_compile_ms['average'] = full_ms if average is None else 0.8 * average + 0.2 * full_ms
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    baseline_ms = state.get('full_ms') or _full_compile_ms['average']
+    saved_ms = baseline_ms - elapsed_ms if success and baseline_ms and mode in ('unchanged', 'incremental') else 0.0
+    report.update({
+        'mode': mode,
+        'passes': passes,
+        'ms': round(elapsed_ms, 1),
+        'full_compile_ms': round(baseline_ms, 1) if baseline_ms else None,
+        'saved_ms': round(saved_ms, 1),
+    })
+    INCREMENTAL_COMPILES.inc(mode=mode)
+    # Counters only go up; the signed saving stays in the report
+    if saved_ms >= 0:
+        INCREMENTAL_SAVED_SECONDS.inc(saved_ms / 1000)
+    else:
+        INCREMENTAL_LOST_SECONDS.inc(-saved_ms / 1000)
+
+    if success:
+        state.update({
+            'inputs': inputs,
+            'preamble': preamble_digest,
+            'sections': sections,
+            'aux': read_bytes(os.path.join(os.path.dirname(pdf_path), 'resume.aux')),
+            'pdf_path': pdf_path,
+        })
+        _incremental_states.put(session_id, state)
+    return success, message, pdf_path, report
+
+
 def extract_text_from_pdf(pdf_file) -> str:
     """Extract text content from uploaded PDF."""
     try:
@@ -374,6 +2089,113 @@ def is_twitter_url(url: str) -> bool:
     return 'twitter.com/' in url.lower() or 'x.com/' in url.lower()
 
 
+# Shared HTTP session for URL scraping - pooled connections are reused across requests
+SCRAPE_TIMEOUT = 10
+SCRAPE_MAX_BYTES = int(os.getenv('SCRAPE_MAX_BYTES', 2 * 1024 * 1024))
+SCRAPE_CACHE_TTL = int(os.getenv('SCRAPE_CACHE_TTL', 600))
+SCRAPE_CACHE_MAX_BYTES = int(os.getenv('SCRAPE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+_http_session: Optional['requests.Session'] = None
+_http_session_lock = threading.Lock()
+
+# Cache of fetched pages, at most SCRAPE_CACHE_MAX_BYTES of bodies in total:
+# {url: (expires_at, html, size)}
+_scrape_cache: Dict[str, Tuple[float, str, int]] = {}
+_scrape_cache_bytes = 0
+_scrape_cache_lock = threading.Lock()
+
+
+def get_http_session() -> 'requests.Session':
+    """Get the shared pooled HTTP session, creating it on first use."""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=20)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _http_session = session
+    return _http_session
+
+
+def clear_scrape_cache():
+    """Drop all cached pages."""
+    global _scrape_cache_bytes
+    with _scrape_cache_lock:
+        _scrape_cache.clear()
+        _scrape_cache_bytes = 0
+
+
+def cache_scraped_page(url: str, html: str, size: int, now: float):
+    """Cache a page, evicting expired pages and then the oldest until the total fits."""
+    global _scrape_cache_bytes
+    if size > SCRAPE_CACHE_MAX_BYTES:
+        return
+    with _scrape_cache_lock:
+        if url in _scrape_cache:
+            _scrape_cache_bytes -= _scrape_cache.pop(url)[2]
+        if _scrape_cache_bytes + size > SCRAPE_CACHE_MAX_BYTES:
+            for key in [k for k, (exp, _, _) in _scrape_cache.items() if exp <= now]:
+                _scrape_cache_bytes -= _scrape_cache.pop(key)[2]
+        # Every entry lives for SCRAPE_CACHE_TTL, so insertion order is expiry order
+        while _scrape_cache_bytes + size > SCRAPE_CACHE_MAX_BYTES:
+            _scrape_cache_bytes -= _scrape_cache.pop(next(iter(_scrape_cache)))[2]
+        _scrape_cache[url] = (now + SCRAPE_CACHE_TTL, html, size)
+        _scrape_cache_bytes += size
+
+
+def fetch_html(url: str, headers: dict, stop_at: Optional[str] = None) -> Tuple[int, str]:
+    """Fetch a page through the shared session. Returns (status_code, html).
+
+    The body is streamed and capped at SCRAPE_MAX_BYTES. If stop_at is given
+    (e.g. '</head>'), the download stops as soon as that marker has arrived.
+    Only 200 responses are cached, per URL, for SCRAPE_CACHE_TTL seconds and
+    up to SCRAPE_CACHE_MAX_BYTES in total.
+    """
+    now = time.monotonic()
+    with _scrape_cache_lock:
+        cached = _scrape_cache.get(url)
+        if cached and cached[0] > now:
+            SCRAPE_FETCHES.inc(result='cache_hit')
+            return 200, cached[1]
+
+    marker = stop_at.lower().encode('ascii') if stop_at else None
+    chunks = []
+    size = 0
+    try:
+        with trace_span('fetch'), get_http_session().get(url, headers=headers, timeout=SCRAPE_TIMEOUT, stream=True) as response:
+            status_code = response.status_code
+            tail = b''
+            for chunk in response.iter_content(chunk_size=16384):
+                if not chunk:
+                    continue
+                chunk = chunk[:SCRAPE_MAX_BYTES - size]
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= SCRAPE_MAX_BYTES:
+                    break
+                if marker:
+                    # Keep a small overlap so a marker split across chunks is still seen
+                    window = tail + chunk.lower()
+                    if marker in window:
+                        break
+                    tail = window[-len(marker):]
+            encoding = response.encoding or 'utf-8'
+    except Exception:
+        SCRAPE_FETCHES.inc(result='error')
+        raise
+
+    html = b''.join(chunks).decode(encoding, errors='replace')
+    if status_code != 200:
+        SCRAPE_FETCHES.inc(result='http_error')
+        return status_code, html
+    SCRAPE_FETCHES.inc(result='success')
+
+    cache_scraped_page(url, html, size, now)
+    return 200, html
+
+
 def scrape_linkedin_profile(url: str) -> str:
     """Attempt to scrape LinkedIn profile. Returns extracted info or error."""
     try:
@@ -383,12 +2205,13 @@ def scrape_linkedin_profile(url: str) -> str:
             'Accept-Language': 'en-US,en;q=0.5',
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        status_code, html = fetch_html(url, headers)
         
-        if response.status_code != 200:
-            return f"Could not access LinkedIn profile (status {response.status_code}). LinkedIn requires authentication for most profiles. Please copy and paste your profile information directly."
+        if status_code != 200:
+            return f"Could not access LinkedIn profile (status {status_code}). LinkedIn requires authentication for most profiles. Please copy and paste your profile information directly."
         
-        soup = BeautifulSoup(response.text, 'html.parser')
+        # Only build the tree for the tags we read below
+        soup = bs4.BeautifulSoup(html, 'html.parser', parse_only=bs4.SoupStrainer(['title', 'meta', 'h1', 'h2', 'h3', 'p', 'span', 'li']))
         
         # Try to extract public profile data
         content_parts = []
@@ -408,9 +2231,11 @@ def scrape_linkedin_profile(url: str) -> str:
             text = tag.get_text(strip=True)
             if text and len(text) > 10 and len(text) < 500:
                 content_parts.append(text)
+                if len(content_parts) >= 50:  # Limit content
+                    break
         
         if content_parts:
-            return "\n".join(content_parts[:50])  # Limit content
+            return "\n".join(content_parts[:50])
         else:
             return "Could not extract LinkedIn profile data. LinkedIn blocks automated access. Please copy and paste your profile information (About, Experience, Education, Skills) directly into the chat."
             
@@ -425,12 +2250,13 @@ def scrape_twitter_profile(url: str) -> str:
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         }
         
-        response = requests.get(url, headers=headers, timeout=10)
+        # Everything we need lives in <head>, so stop downloading once it closes
+        status_code, html = fetch_html(url, headers, stop_at='</head>')
         
-        if response.status_code != 200:
+        if status_code != 200:
             return f"Could not access Twitter profile. Please copy and paste your bio and relevant tweets."
         
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = bs4.BeautifulSoup(html, 'html.parser', parse_only=bs4.SoupStrainer(['title', 'meta']))
         
         content_parts = []
         
@@ -461,29 +2287,35 @@ def scrape_twitter_profile(url: str) -> str:
 def scrape_url(url: str) -> str:
     """Scrape content from a URL."""
     if is_linkedin_url(url):
-        return scrape_linkedin_profile(url)
+        with SCRAPE_SECONDS.time(kind='linkedin'):
+            return scrape_linkedin_profile(url)
     elif is_twitter_url(url):
-        return scrape_twitter_profile(url)
-    else:
-        # Generic URL scraping
-        try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
-            }
-            response = requests.get(url, headers=headers, timeout=10)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Remove scripts and styles
-            for tag in soup(['script', 'style', 'nav', 'footer', 'header']):
-                tag.decompose()
-            
-            text = soup.get_text(separator='\n', strip=True)
-            # Clean up whitespace
-            lines = [line.strip() for line in text.split('\n') if line.strip()]
-            return '\n'.join(lines[:100])  # Limit content
-            
-        except Exception as e:
-            return f"Error fetching URL: {str(e)}"
+        with SCRAPE_SECONDS.time(kind='twitter'):
+            return scrape_twitter_profile(url)
+    with SCRAPE_SECONDS.time(kind='web'):
+        return scrape_web_page(url)
+
+
+def scrape_web_page(url: str) -> str:
+    """Scrape the visible text of a generic web page."""
+    try:
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
+        }
+        _, html = fetch_html(url, headers)
+        soup = bs4.BeautifulSoup(html, 'html.parser')
+        
+        # Remove scripts and styles
+        for tag in soup(['script', 'style', 'nav', 'footer', 'header']):
+            tag.decompose()
+        
+        text = soup.get_text(separator='\n', strip=True)
+        # Clean up whitespace
+        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        return '\n'.join(lines[:100])  # Limit content
+        
+    except Exception as e:
+        return f"Error fetching URL: {str(e)}"
 
 
 def is_image_file(filename: str) -> bool:
@@ -533,14 +2365,16 @@ Format the output as plain text that can be used to recreate this resume."""
         if message:
             prompt += f"\n\nAdditional user request: {message}"
         
-        model = get_model(pro_mode)
-        response = model.generate_content(
+        response = generate_content(
+            'vision', pro_mode,
             [prompt, image_part],
             generation_config=genai.types.GenerationConfig(temperature=0.2)
         )
         
         return response.text.strip()
         
+    except Overloaded:
+        raise  # Answered with 503 by handle_overloaded
     except Exception as e:
         return f"Error processing image: {str(e)}"
 
@@ -580,8 +2414,8 @@ Do NOT output any LaTeX code. Respond conversationally."""
 def validate_request(user_input: str, pro_mode: bool = False) -> tuple:
     """Check request type. Returns (request_type, message)."""
     try:
-        model = get_model(pro_mode)
-        response = model.generate_content(
+        response = generate_content(
+            'validate', pro_mode,
             [VALIDATION_PROMPT, f"User input: {user_input}"],
             generation_config=genai.types.GenerationConfig(temperature=0.1)
         )
@@ -597,6 +2431,8 @@ def validate_request(user_input: str, pro_mode: bool = False) -> tuple:
         else:
             return "invalid", "I'm a resume builder assistant. I can help you create, modify, or improve resumes. Please provide resume-related information or upload a resume PDF."
             
+    except Overloaded:
+        raise  # Retrying with another model call would only add to the queue
     except Exception as e:
         return "generate", None
 
@@ -605,12 +2441,14 @@ def get_advice_response(question: str, context: str = "", pro_mode: bool = False
     """Get conversational advice about resume content."""
     try:
         prompt = ADVICE_PROMPT.format(context=context or "No resume loaded yet", question=question)
-        model = get_model(pro_mode)
-        response = model.generate_content(
+        response = generate_content(
+            'advice', pro_mode,
             prompt,
             generation_config=genai.types.GenerationConfig(temperature=0.7)
         )
         return response.text.strip()
+    except Overloaded:
+        raise
     except Exception as e:
         return f"I'd be happy to help with that! Could you provide more details about what you'd like to change?"
 
@@ -631,8 +2469,8 @@ Remember: Output ONLY valid LaTeX code, no explanations."""
 
 Remember: Output ONLY valid LaTeX code, no explanations or markdown code blocks."""
         
-        model = get_model(pro_mode)
-        response = model.generate_content(
+        response = generate_content(
+            'generate', pro_mode,
             [LATEX_SYSTEM_PROMPT, prompt],
             generation_config=genai.types.GenerationConfig(
                 temperature=0.3,
@@ -652,29 +2490,272 @@ Remember: Output ONLY valid LaTeX code, no explanations or markdown code blocks.
         
         return latex_code
         
+    except Overloaded:
+        raise
     except Exception as e:
         return f"Error generating LaTeX: {str(e)}"
 
 
+@app.before_request
+def start_trace():
+    trace = Trace()
+    g.trace = trace
+    g.trace_token = _current_trace.set(trace)
+    if should_profile(request.headers):
+        g.profiler = SamplingProfiler(trace)
+        g.profiler.start()
+
+
+@app.teardown_request
+def reset_request_context(exc=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        _current_trace.reset(token)
+    token = g.pop('fairness_token', None)
+    if token is not None:
+        _fairness_key.reset(token)
+
+
+@app.after_request
+def finish_trace(response):
+    # Registered before the other after_request hooks so it runs last and the
+    # total includes compression
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    response.headers['Server-Timing'] = trace.server_timing()
+    response.headers['X-Trace-Id'] = trace.trace_id
+    profiler = g.pop('profiler', None)
+    if profiler:
+        response.headers['X-Profile-Id'] = trace.trace_id
+    if profiler or TRACE_LOG == 'json':
+        # Streamed bodies are still being generated here; finish once they are sent
+        method, path, status = request.method, request.path, response.status_code
+
+        def on_close():
+            if profiler:
+                try:
+                    profiler.stop()
+                except OSError as e:
+                    print(f"Error writing profile: {e}")
+            if TRACE_LOG == 'json':
+                entry = {'method': method, 'path': path, 'status': status}
+                entry.update(trace.to_dict())
+                print(json.dumps(entry), flush=True)
+
+        response.call_on_close(on_close)
+    return response
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    METRICS.start_flusher()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
+
+
+# Rate-limited POST routes: {rule: (limits name, queue their work waits in)}
+ADMISSION_ROUTES = {
+    '/chat': ('chat', MODEL_SCHEDULER),
+    '/compile': ('compile', COMPILE_SCHEDULER),
+    # One token here; compile_batch_pdf charges the rest per item once it has the body
+    '/compile/batch': ('compile_batch', COMPILE_SCHEDULER),
+}
+
+
+def request_session_id() -> Optional[str]:
+    """Session id from the X-Session-Id header; the body is never read for it."""
+    session_id = request.headers.get('X-Session-Id')
+    return safe_chat_id(session_id)[:64] or None if session_id else None
+
+
+def reject_request(route: str, reason: str, retry_after: float):
+    """429 for a rate limit, 503 for a full queue, with Retry-After."""
+    ADMISSION_REJECTED.inc(route=route, reason=reason)
+    if reason == 'queue':
+        response = jsonify({'success': False, 'error': 'The server is busy right now. Please try again in a moment.'})
+        response.status_code = 503
+    else:
+        seconds = max(1, math.ceil(retry_after))
+        response = jsonify({'success': False, 'error': f'Too many requests. Please wait {seconds} seconds and try again.'})
+        response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    """A model queue that is full or timed out mid-request gets the same 503 as at admission."""
+    rule = request.url_rule.rule if request.url_rule else None
+    route = ADMISSION_ROUTES.get(rule, ('model', None))[0]
+    return reject_request(route, 'queue', 5)
+
+
+@app.before_request
+def admit_request():
+    """Shed over-limit /chat and /compile requests before their body is read."""
+    if request.method != 'POST' or request.url_rule is None:
+        return None
+    entry = ADMISSION_ROUTES.get(request.url_rule.rule)
+    if entry is None:
+        return None
+    route, scheduler = entry
+    session_id = request_session_id()
+    client = request.remote_addr or '-'
+    g.fairness_token = _fairness_key.set(session_id or client)
+    if scheduler.saturated():
+        return reject_request(route, 'queue', 5)
+    denied = admit(route, session_id, client)
+    if denied:
+        return reject_request(route, *denied)
+    return None
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics, merged across all workers."""
+    try:
+        METRICS.flush()
+    except OSError:
+        pass  # Still serve this worker's numbers
+    return app.response_class(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+
+# Vite emits content-hashed bundles such as assets/index-B4x9Qz1a.js; these never
+# change under the same name, so browsers may cache them for good
+HASHED_ASSET_RE = re.compile(r'(^|/)assets/.+-[A-Za-z0-9_-]{8,}\.[a-z0-9]+$')
+
+# Responses worth compressing, and the size below which it isn't worth it
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/javascript', 'text/javascript', 'text/html',
+    'text/css', 'text/plain', 'image/svg+xml',
+}
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MAX_SIZE = 8 * 1024 * 1024
+
+# {(etag, encoding): compressed body} for static files, so hot bundles compress once.
+# Bounded by size too: a single body may be up to COMPRESS_MAX_SIZE
+STATIC_COMPRESS_CACHE_BYTES = int(os.getenv('STATIC_COMPRESS_CACHE_BYTES', 16 * 1024 * 1024))
+_compressed_static = LRUCache(128, max_bytes=STATIC_COMPRESS_CACHE_BYTES)
+
+# {(path, mtime_ns, size): content hash} - generated files never change in place
+_file_hashes = LRUCache(512)
+
+
+def file_content_hash(path: str) -> str:
+    """SHA-256 of a file's contents, cached by path and stat."""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    digest = _file_hashes.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()[:32]
+        _file_hashes.put(key, digest)
+    return digest
+
+
+def negotiate_encoding() -> Optional[str]:
+    """Pick 'br' or 'gzip' from the request's Accept-Encoding, if either is acceptable."""
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return None
+
+
+@app.after_request
+def compress_response(response):
+    """Gzip/brotli-compress JSON and text responses when the client accepts it."""
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or request.method == 'HEAD':
+        return response
+    length = response.content_length
+    if length is not None and not COMPRESS_MIN_SIZE <= length <= COMPRESS_MAX_SIZE:
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    
+    # Each encoding is its own representation, so give it its own strong ETag
+    etag, weak = response.get_etag()
+    encoded_etag = f'{etag}-{encoding}' if etag else None
+    if encoded_etag and request.if_none_match.contains(encoded_etag):
+        not_modified = app.response_class(status=304)
+        not_modified.set_etag(encoded_etag, weak)
+        not_modified.headers['Cache-Control'] = response.headers.get('Cache-Control', '')
+        not_modified.vary.add('Accept-Encoding')
+        return not_modified
+    
+    cache_key = (encoded_etag, encoding) if response.direct_passthrough and etag else None
+    body = _compressed_static.get(cache_key) if cache_key else None
+    if body is None:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        body = brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, compresslevel=6)
+        if cache_key:
+            _compressed_static.put(cache_key, body)
+    
+    response.direct_passthrough = False
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if encoded_etag:
+        response.set_etag(encoded_etag, weak)
+    return response
+
+
+def send_static_file(path: str):
+    """Send a file from STATIC_DIR with cache headers suited to it."""
+    if HASHED_ASSET_RE.search(path):
+        response = send_from_directory(STATIC_DIR, path, max_age=31536000)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        # Unhashed files (index.html, logos) may change on deploy - always revalidate
+        response = send_from_directory(STATIC_DIR, path)
+        response.cache_control.no_cache = True
+    return response
+
+
 @app.route('/')
 def index():
     # Serve React frontend in production, Flask template in development
-    static_dir = os.path.join(os.path.dirname(__file__), 'static')
-    if os.path.exists(os.path.join(static_dir, 'index.html')):
-        return send_from_directory(static_dir, 'index.html')
-    return render_template('index.html', templates=list(SAMPLE_TEMPLATES.keys()))
+    try:
+        return send_static_file('index.html')
+    except NotFound:
+        return render_template('index.html', templates=list(SAMPLE_TEMPLATES.keys()))
 
 
 @app.route('/<path:path>')
 def serve_static(path):
     """Serve static files for React frontend."""
-    static_dir = os.path.join(os.path.dirname(__file__), 'static')
-    if os.path.exists(os.path.join(static_dir, path)):
-        return send_from_directory(static_dir, path)
+    try:
+        return send_static_file(path)
+    except NotFound:
+        pass
     # For client-side routing, return index.html
-    if os.path.exists(os.path.join(static_dir, 'index.html')):
-        return send_from_directory(static_dir, 'index.html')
-    return "Not found", 404
+    try:
+        return send_static_file('index.html')
+    except NotFound:
+        return "Not found", 404
 
 
 @app.route('/get_template/<name>')
@@ -692,25 +2773,331 @@ def compile_pdf():
     if not latex_code.strip():
         return jsonify({'success': False, 'error': 'No LaTeX code provided'})
     
-    success, message, pdf_path = compile_latex(latex_code, session_id)
+    incremental = request.json.get('incremental', INCREMENTAL_COMPILE)
+    report = None
+    if incremental and session_id:
+        success, message, pdf_path, report = compile_latex_incremental(latex_code, session_id)
+    else:
+        success, message, pdf_path = compile_latex(latex_code, session_id)
     
     if success and pdf_path:
         job_id = os.path.basename(os.path.dirname(pdf_path))
-        return jsonify({
+        payload = {
             'success': True, 
             'message': message,
             'pdf_url': f'/pdf/{job_id}'
-        })
+        }
     else:
-        return jsonify({'success': False, 'error': message})
+        payload = {'success': False, 'error': message}
+    if report:
+        payload['incremental'] = report
+    return jsonify(payload)
+
+
+# A /compile/batch request runs inside one worker, which gunicorn kills after
+# its 120 s timeout (gunicorn.conf.py). Items are capped, and compiles not
+# started within BATCH_COMPILE_TIMEOUT seconds are reported as skipped so the
+# response always finishes in time; larger batches belong to the CLI
+BATCH_COMPILE_MAX_ITEMS = int(os.getenv('BATCH_COMPILE_MAX_ITEMS', 40))
+BATCH_COMPILE_TIMEOUT = float(os.getenv('BATCH_COMPILE_TIMEOUT', 90))
+
+
+def resolve_batch_item(item) -> dict:
+    """Normalize a batch item to a dict with 'latex_code', loading it from history for session-only items."""
+    if isinstance(item, str):
+        item = {'latex_code': item}
+    elif not isinstance(item, dict):
+        item = {}
+    if not item.get('latex_code') and item.get('session_id'):
+        latex = load_chat_history(item['session_id'], fields={'latex'}).get('latex') or ''
+        item = {**item, 'latex_code': latex}
+    return item
+
+
+def run_batch_compile(deadline: Optional[float], latex: str, session_id: Optional[str]):
+    """Timed compile_latex, or None if the batch deadline passed before it could start."""
+    if deadline is not None and time.monotonic() > deadline:
+        return None
+    return run_timed(compile_latex, latex, session_id)
+
+
+def compile_batch(items: list, max_workers: Optional[int] = None, timeout: Optional[float] = None):
+    """Compile many documents in parallel, compiling identical inputs only once.
+    
+    items are dicts with 'latex_code' and optional 'id' / 'session_id'. Yields a
+    result dict per item as soon as its compile finishes, then {'summary': {...}}.
+    With a timeout, compiles not started within that many seconds are skipped.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    start = time.perf_counter()
+    groups: Dict[str, list] = {}  # {input key: [item indexes]}
+    sources: Dict[str, tuple] = {}
+    results = []
+    
+    for index, item in enumerate(items):
+        latex = item.get('latex_code') or ''
+        if not latex.strip():
+            results.append({'index': index, 'id': item.get('id', index), 'success': False, 'error': 'No LaTeX code provided'})
+            continue
+        session_id = item.get('session_id')
+        key = hashlib.sha256(latex.encode('utf-8')).hexdigest()
+        if session_id and SESSION_IMAGES.get(session_id):
+            key += ':' + session_id  # Same source, different images
+        if key not in groups:
+            groups[key] = []
+            sources[key] = (latex, session_id)
+        groups[key].append(index)
+    yield from results
+    
+    compile_ms = 0.0
+    skipped_groups = 0
+    if groups:
+        workers = max(1, min(max_workers or os.cpu_count() or 1, os.cpu_count() or 1, len(groups)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-compile') as pool:
+            # In the caller's context, so each compile queues under the caller's fairness key
+            futures = {traced_submit(pool, 'batch.compile', run_batch_compile, deadline, *sources[key]): key
+                       for key in groups}
+            for future in as_completed(futures):
+                indexes = groups[futures[future]]
+                timed = future.result()
+                if timed is None:
+                    skipped_groups += 1
+                    for index in indexes:
+                        result = {'index': index, 'id': items[index].get('id', index), 'success': False,
+                                  'skipped': True, 'error': 'Batch time limit reached before this item was compiled'}
+                        results.append(result)
+                        yield result
+                    continue
+                (success, message, pdf_path), ms = timed
+                compile_ms += ms
+                first_id = items[indexes[0]].get('id', indexes[0])
+                for index in indexes:
+                    result = {'index': index, 'id': items[index].get('id', index), 'success': success,
+                              'duration_ms': round(ms, 1)}
+                    if success:
+                        result['pdf_url'] = f'/pdf/{os.path.basename(os.path.dirname(pdf_path))}'
+                    else:
+                        result['error'] = message
+                    if index != indexes[0]:
+                        result['duplicate_of'] = first_id
+                    results.append(result)
+                    yield result
+    
+    succeeded = sum(1 for r in results if r['success'])
+    yield {'summary': {
+        'items': len(items),
+        'compiled': len(groups) - skipped_groups,
+        'duplicates': sum(len(indexes) - 1 for indexes in groups.values()),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'skipped': sum(1 for r in results if r.get('skipped')),
+        'compile_ms': round(compile_ms, 1),
+        'wall_ms': round((time.perf_counter() - start) * 1000, 1),
+    }}
+
+
+@app.route('/compile/batch', methods=['POST'])
+def compile_batch_pdf():
+    """Compile many documents at once, streaming one JSON line per item plus a summary."""
+    data = request.json or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'No items provided'})
+    if len(items) > BATCH_COMPILE_MAX_ITEMS:
+        return jsonify({'success': False, 'error': f'Too many items (max {BATCH_COMPILE_MAX_ITEMS})'})
+    if len(items) > 1:
+        denied = admit('compile_batch', request_session_id(), request.remote_addr or '-', cost=len(items) - 1)
+        if denied:
+            return reject_request('compile_batch', *denied)
+    
+    items = [resolve_batch_item(item) for item in items]
+    workers = data.get('workers') if isinstance(data.get('workers'), int) else None
+    lines = (json.dumps(result) + '\n' for result in compile_batch(items, workers, BATCH_COMPILE_TIMEOUT))
+    return app.response_class(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
+@app.cli.command('compile-batch')
+@click.argument('tex_files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--session', 'session_ids', multiple=True, help='Compile the current LaTeX of this session (repeatable).')
+@click.option('--all-sessions', is_flag=True, help='Compile every session in the history store.')
+@click.option('--templates', is_flag=True, help='Compile every built-in sample template.')
+@click.option('--jobs', type=int, default=None, help='Parallel compiles (default: CPU count).')
+def compile_batch_command(tex_files, session_ids, all_sessions, templates, jobs):
+    """Compile many resumes in parallel and print one JSON line per item."""
+    items = []
+    for path in tex_files:
+        with open(path, 'r', encoding='utf-8') as f:
+            items.append({'id': path, 'latex_code': f.read()})
+    if templates:
+        items += [{'id': f'template:{name}', 'latex_code': code} for name, code in SAMPLE_TEMPLATES.items()]
+    if all_sessions:
+        session_ids = list(session_ids) + [s['id'] for s in get_history_store().list_sessions()]
+    items += [resolve_batch_item({'id': session_id, 'session_id': session_id}) for session_id in session_ids]
+    if not items:
+        raise click.UsageError('Nothing to compile: pass .tex files, --session, --all-sessions or --templates.')
+    
+    failed = 0
+    for result in compile_batch(items, jobs):
+        click.echo(json.dumps(result))
+        failed = result.get('summary', {}).get('failed', failed)
+    if failed:
+        raise click.exceptions.Exit(1)
 
 
 @app.route('/pdf/<job_id>')
 def serve_pdf(job_id):
-    pdf_path = os.path.join(TEMP_DIR, job_id, 'resume.pdf')
-    if os.path.exists(pdf_path):
-        return send_file(pdf_path, mimetype='application/pdf')
-    return "PDF not found", 404
+    pdf_path = os.path.join(TEMP_DIR, secure_filename(job_id), 'resume.pdf')
+    try:
+        etag = file_content_hash(pdf_path)
+    except FileNotFoundError:
+        return "PDF not found", 404
+    # send_file handles If-None-Match (304) and Range/If-Range (206) for PDF.js
+    response = send_file(pdf_path, mimetype='application/pdf', etag=etag, max_age=86400)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+
+# First-page previews, rendered with pdftoppm on a small background pool and
+# cached on disk per PDF content hash, so identical versions share a render
+THUMBNAIL_DIR = os.path.join(TEMP_DIR, 'thumbnails')
+THUMBNAIL_WIDTHS = {'small': 160, 'medium': 320, 'large': 640}
+THUMBNAIL_WAIT = float(os.getenv('THUMBNAIL_WAIT', 10))
+THUMBNAIL_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('THUMBNAIL_WORKERS', 2)), thread_name_prefix='thumbnail')
+
+# Renders in progress: {cache file name: future}, so concurrent requests share one
+_thumbnail_jobs: Dict[str, Future] = {}
+_thumbnail_jobs_lock = threading.Lock()
+
+
+@cache_tool_path
+def find_pdftoppm() -> Optional[str]:
+    """Find pdftoppm executable (poppler-utils)."""
+    if shutil.which('pdftoppm'):
+        return 'pdftoppm'
+    
+    common_paths = [
+        '/opt/homebrew/bin/pdftoppm',
+        '/usr/local/bin/pdftoppm',
+        '/usr/bin/pdftoppm',
+    ]
+    
+    for path in common_paths:
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    
+    return None
+
+
+def render_thumbnail(pdf_path: str, out_path: str, width: int, fmt: str) -> Optional[str]:
+    """Render page 1 of a PDF to out_path. Returns an error message, or None on success."""
+    pdftoppm_path = find_pdftoppm()
+    if not pdftoppm_path:
+        return "pdftoppm not found. Install poppler-utils to enable thumbnails."
+    
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    prefix = f'{out_path}.{uuid.uuid4().hex}'
+    png_path = prefix + '.png'
+    try:
+        result = subprocess.run(
+            [pdftoppm_path, '-png', '-f', '1', '-l', '1', '-singlefile',
+             '-scale-to-x', str(width), '-scale-to-y', '-1', pdf_path, prefix],
+            capture_output=True,
+            text=True,
+            timeout=30
+        )
+        if result.returncode != 0 or not os.path.exists(png_path):
+            return f"Thumbnail rendering failed: {result.stderr.strip() or result.returncode}"
+        
+        if fmt == 'webp':
+            webp_path = prefix + '.webp'
+            with Image.open(png_path) as image:
+                image.save(webp_path, 'WEBP', quality=80)
+            os.replace(webp_path, out_path)
+        else:
+            os.replace(png_path, out_path)
+        return None
+    except subprocess.TimeoutExpired:
+        return "Thumbnail rendering timed out."
+    except (OSError, ValueError, KeyError) as e:
+        # e.g. Pillow can't read pdftoppm's output or has no WebP support
+        return f"Thumbnail rendering failed: {e}"
+    finally:
+        for leftover in (png_path, prefix + '.webp'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def request_thumbnail(pdf_path: str, size: str, fmt: str) -> Tuple[str, Optional[Future]]:
+    """Get the cached thumbnail path, plus the pending render if it isn't on disk yet."""
+    name = f'{file_content_hash(pdf_path)}-{size}.{fmt}'
+    out_path = os.path.join(THUMBNAIL_DIR, name)
+    if os.path.exists(out_path):
+        return out_path, None
+    
+    with _thumbnail_jobs_lock:
+        future = _thumbnail_jobs.get(name)
+        if future is None:
+            future = THUMBNAIL_EXECUTOR.submit(render_thumbnail, pdf_path, out_path, THUMBNAIL_WIDTHS[size], fmt)
+            _thumbnail_jobs[name] = future
+            
+            def forget(_):
+                with _thumbnail_jobs_lock:
+                    _thumbnail_jobs.pop(name, None)
+            future.add_done_callback(forget)
+    return out_path, future
+
+
+@app.route('/pdf/<job_id>/thumbnail')
+def serve_thumbnail(job_id):
+    """Serve a first-page thumbnail (?size=small|medium|large, ?format=png|webp)."""
+    size = request.args.get('size', 'small')
+    if size not in THUMBNAIL_WIDTHS:
+        return "Unknown thumbnail size", 400
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'webp' if Image is not None and request.accept_mimetypes['image/webp'] else 'png'
+    elif fmt == 'webp' and Image is None:
+        fmt = 'png'
+    if fmt not in ('png', 'webp'):
+        return "Unknown thumbnail format", 400
+    
+    pdf_path = os.path.join(TEMP_DIR, secure_filename(job_id), 'resume.pdf')
+    if not os.path.exists(pdf_path):
+        return "PDF not found", 404
+    
+    out_path, future = request_thumbnail(pdf_path, size, fmt)
+    if future is not None:
+        try:
+            error = future.result(timeout=THUMBNAIL_WAIT)
+        except FutureTimeoutError:
+            # Still rendering in the background - ask the client to come back
+            response = app.response_class("Thumbnail is being rendered", status=202)
+            response.headers['Retry-After'] = '1'
+            return response
+        if error:
+            return error, 500
+    
+    # The file name is derived from the PDF's content, so it never changes
+    response = send_file(out_path, mimetype=f'image/{fmt}', etag=os.path.basename(out_path), max_age=31536000)
+    response.cache_control.immutable = True
+    if 'format' not in request.args:
+        response.vary.add('Accept')
+    return response
+
+
+# Executor for independent /chat stages (URL scraping, file extraction). In
+# async mode its workers are greenlets and every in-flight request may use one
+CHAT_STAGE_WORKERS = int(os.getenv('CHAT_STAGE_WORKERS', 256 if cooperative_io() else 8))
+CHAT_STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=CHAT_STAGE_WORKERS, thread_name_prefix='chat-stage')
+
+
+def run_timed(func, *args, **kwargs):
+    """Call func and return (result, elapsed_ms)."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
 
 
 @app.route('/chat', methods=['POST'])
@@ -720,14 +3107,33 @@ def chat():
     uploaded_file = request.files.get('pdf')
     current_latex = request.form.get('current_latex', '')
     pro_mode = request.form.get('pro_mode', 'false').lower() == 'true'
+    has_file = bool(uploaded_file and uploaded_file.filename)
+    
+    if pro_mode:
+        # admit_request charged one token; PRO mode costs pro_cost in all
+        denied = admit('chat', request_session_id(), request.remote_addr or '-', get_admission_config()['pro_cost'] - 1)
+        if denied:
+            return reject_request('chat', *denied)
     
     user_input = message
     file_content = ""
     
-    # Check for URLs in message (LinkedIn, Twitter, etc.)
+    # URL scraping and file extraction don't depend on each other - start both
+    # before waiting on either so the network fetch overlaps PDF/vision work
     url = extract_url_from_text(message)
-    if url:
-        scraped_content = scrape_url(url)
+    scrape_future = traced_submit(CHAT_STAGE_EXECUTOR, 'scrape', scrape_url, url) if url else None
+    extract_future = None
+    if has_file:
+        if is_image_file(uploaded_file.filename):
+            # Process image with Gemini vision
+            extract_future = traced_submit(CHAT_STAGE_EXECUTOR, 'extract', process_image_with_gemini, uploaded_file, message, pro_mode)
+        else:
+            # Process PDF
+            extract_future = traced_submit(CHAT_STAGE_EXECUTOR, 'extract', extract_text_from_pdf, uploaded_file)
+    
+    # Check for URLs in message (LinkedIn, Twitter, etc.)
+    if scrape_future:
+        scraped_content = scrape_future.result()
         if is_linkedin_url(url):
             user_input = f"LinkedIn profile content:\n{scraped_content}\n\nUser request: {message}"
         elif is_twitter_url(url):
@@ -735,27 +3141,24 @@ def chat():
         else:
             user_input = f"Web page content:\n{scraped_content}\n\nUser request: {message}"
     
-    # If file uploaded, process based on type
-    if uploaded_file and uploaded_file.filename:
-        if is_image_file(uploaded_file.filename):
-            # Process image with Gemini vision
-            file_content = process_image_with_gemini(uploaded_file, message, pro_mode)
-            user_input = f"Resume content from image:\n{file_content}\n\nUser request: {message}" if message else f"Create a LaTeX resume from this content:\n{file_content}"
-        else:
-            # Process PDF
-            file_content = extract_text_from_pdf(uploaded_file)
-            user_input = f"Resume content from PDF:\n{file_content}\n\nUser request: {message}" if message else f"Create a LaTeX resume from this content:\n{file_content}"
+    # If file uploaded, use its extracted content
+    if extract_future:
+        file_content = extract_future.result()
+        source = "image" if is_image_file(uploaded_file.filename) else "PDF"
+        user_input = f"Resume content from {source}:\n{file_content}\n\nUser request: {message}" if message else f"Create a LaTeX resume from this content:\n{file_content}"
     
     if not user_input.strip():
         return jsonify({'success': False, 'error': 'Please provide some input'})
     
-    # Skip validation if file was uploaded or URL provided - assume it's resume-related
-    if (uploaded_file and uploaded_file.filename) or url:
+    # Skip validation if file was uploaded or URL provided - assume it's resume-related.
+    # The classifier therefore only runs when there is nothing to overlap it with.
+    if has_file or url:
         request_type = "generate"
         error_message = None
     else:
         # Validate and categorize the request
-        request_type, error_message = validate_request(user_input, pro_mode)
+        with trace_span('validate'):
+            request_type, error_message = validate_request(user_input, pro_mode)
     
     if request_type == "invalid":
         return jsonify({'success': False, 'error': error_message, 'is_chat_response': True})
@@ -763,14 +3166,18 @@ def chat():
     if request_type == "question":
         # User is asking for advice - respond conversationally with full context
         context = current_latex if current_latex else "No resume loaded yet. Please create or upload a resume first."
-        advice = get_advice_response(message, context, pro_mode)
+        with trace_span('advice'):
+            advice = get_advice_response(message, context, pro_mode)
         return jsonify({'success': False, 'error': advice, 'is_chat_response': True})
     
     # request_type == "generate" - create/modify resume
     if current_latex and message and not uploaded_file:
         user_input = f"Current LaTeX code:\n{current_latex}\n\nModification request: {message}"
     
-    latex_code = generate_latex_with_gemini(user_input, is_modification=bool(current_latex and not uploaded_file), pro_mode=pro_mode)
+    with trace_span('generate'):
+        latex_code = generate_latex_with_gemini(
+            user_input, is_modification=bool(current_latex and not uploaded_file), pro_mode=pro_mode
+        )
     
     if latex_code.startswith('Error'):
         return jsonify({'success': False, 'error': latex_code})
@@ -780,24 +3187,74 @@ def chat():
 
 @app.route('/history', methods=['GET'])
 def get_history():
-    """Get chat history for a specific session."""
+    """Get chat history for a specific session.
+    
+    Optional query args:
+    - checkpoints=lazy: omit checkpoint LaTeX; fetch one with /history/checkpoint
+    - fields=messages,latex: only return these keys
+    - limit=N, before=I: page through messages, latest first
+    """
     session_id = request.args.get('sessionId')
-    history = load_chat_history(session_id)
+    lazy = request.args.get('checkpoints') == 'lazy'
+    fields = request.args.get('fields')
+    fields = {f.strip() for f in fields.split(',') if f.strip()} if fields else None
+    history = load_chat_history(
+        session_id,
+        lazy_checkpoints=lazy,
+        fields=fields,
+        limit=request.args.get('limit', type=int),
+        before=request.args.get('before', type=int),
+    )
     return jsonify(history)
 
 
+@app.route('/history/checkpoint', methods=['GET'])
+def get_history_checkpoint():
+    """Get the LaTeX of a single checkpoint."""
+    session_id = request.args.get('sessionId')
+    checkpoint_id = request.args.get('id')
+    if not session_id or checkpoint_id is None:
+        return jsonify({'success': False, 'error': 'Missing session ID or checkpoint ID'})
+    latex = load_checkpoint_latex(session_id, checkpoint_id)
+    if latex is None:
+        return jsonify({'success': False, 'error': 'Checkpoint not found'})
+    return jsonify({'success': True, 'id': checkpoint_id, 'latex': latex})
+
+
 @app.route('/history', methods=['POST'])
 def update_history():
     """Update chat history for a specific session."""
     data = request.json
     session_id = data.get('sessionId')
     if session_id:
-        # Remove sessionId from data before saving
-        history_data = {k: v for k, v in data.items() if k != 'sessionId'}
+        # A page from a paged GET is not the whole session; saving it would drop the rest
+        offset = data.get('messageOffset')
+        count = data.get('messageCount')
+        partial = (offset is not None and offset != 0) or (
+            count is not None and (not isinstance(count, int) or len(data.get('messages') or []) < count))
+        if partial:
+            return jsonify({'success': False, 'error': 'Cannot save a page of messages; send the full history or use PATCH /history'})
+        history_data = {k: v for k, v in data.items() if k not in ('sessionId', 'messageOffset', 'messageCount')}
         save_chat_history(history_data, session_id)
     return jsonify({'success': True})
 
 
+@app.route('/history', methods=['PATCH'])
+def patch_history():
+    """Apply partial updates to a session instead of re-sending all of it."""
+    data = request.json or {}
+    session_id = data.get('sessionId')
+    ops = data.get('ops')
+    if not session_id or not isinstance(ops, list):
+        return jsonify({'success': False, 'error': 'Missing session ID or ops'})
+    try:
+        with HISTORY_SECONDS.time(op='patch', backend=HISTORY_BACKEND), trace_span('history.patch'):
+            get_history_store().update(session_id, lambda old: history_patch_ops(old, ops))
+    except (ValueError, KeyError, TypeError) as e:
+        return jsonify({'success': False, 'error': f'Invalid history operation: {e}'})
+    return jsonify({'success': True})
+
+
 @app.route('/history/clear', methods=['POST'])
 def clear_history():
     """Clear chat history for a specific session."""
@@ -891,6 +3348,7 @@ def delete_image():
     return jsonify({'success': False, 'error': 'Image not found'})
 
 
+@cache_tool_path
 def find_synctex() -> Optional[str]:
     """Find synctex executable."""
     if shutil.which('synctex'):
@@ -1023,5 +3481,49 @@ def synctex_reverse(job_id):
         return jsonify({'success': False, 'error': str(e)})
 
 
+def warm_up() -> Dict[str, float]:
+    """Pay the first request's one-time costs now. Returns milliseconds per step.
+
+    The pdflatex step compiles a sample template once so the TeX format,
+    fonts and kpathsea file lookups are loaded and in the OS page cache.
+    """
+    timings = {}
+
+    def step(name, func):
+        start = time.perf_counter()
+        func()
+        timings[name] = (time.perf_counter() - start) * 1000
+
+    step('imports', lambda: (genai.GenerativeModel, PyPDF2.PdfReader, bs4.BeautifulSoup, requests.Session))
+    step('models', lambda: (get_model(False), get_model(True)))
+    step('tools', lambda: (find_pdflatex(), find_synctex(), find_pdftoppm()))
+    step('http', get_http_session)
+
+    def compile_template():
+        if not find_pdflatex():
+            return
+        success, message, pdf_path = _compile_latex(next(iter(SAMPLE_TEMPLATES.values())))
+        if pdf_path:
+            shutil.rmtree(os.path.dirname(pdf_path), ignore_errors=True)
+        if not success:
+            print(f"Warm-up compile failed: {message}")
+
+    step('pdflatex', compile_template)
+    return timings
+
+
+@app.cli.command('warm-up')
+def warm_up_command():
+    """Run the warm-up steps and print how long each took."""
+    for name, ms in warm_up().items():
+        click.echo(f'{name:<10} {ms:8.1f} ms')
+
+
+# WARM_UP=1 warms up at import; with gunicorn --preload that happens once in
+# the master and every forked worker starts warm
+if os.getenv('WARM_UP', '').lower() in ('1', 'true', 'yes'):
+    warm_up()
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5050)
@@ -0,0 +1,540 @@
+"""Benchmark the request pipeline.
+
+Drives /compile, /chat (against a fake model), /synctex/* and /history with
+payloads built from SAMPLE_TEMPLATES and chat_histories/, at several
+concurrency levels, and writes p50/p95/p99 latency, throughput and pdflatex
+CPU time per compile as JSON so results can be compared across commits.
+
+    python benchmarks/bench.py run                                # in-process server
+    python benchmarks/bench.py run --scenarios history --concurrency 1,8,32
+    python benchmarks/bench.py run --url http://127.0.0.1:8000    # external server
+    python benchmarks/bench.py compare before.json after.json
+    python benchmarks/bench.py import-time --budget-ms 400
+    python benchmarks/bench.py capacity --workers 1 --concurrency 1,8,32,128
+
+By default the app is served in this process by werkzeug's threaded server,
+with the fake model installed and history written to a temporary directory.
+Client and server then share one interpreter, so for capacity numbers run the
+server separately (see fake_backend.py) and pass --url; pdflatex CPU time is
+only measured in-process. Servers started here have rate limits lifted
+(UNLIMITED_ADMISSION); give an external one the same ADMISSION_CONFIG.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+import requests
+
+from fake_backend import StubSite, install_fake_model, resume_app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def load_documents() -> list:
+    """LaTeX documents: the sample templates plus the latex of saved sessions."""
+    documents = list(resume_app.SAMPLE_TEMPLATES.values())
+    for session in load_sessions():
+        if session.get('latex'):
+            documents.append(session['latex'])
+    return documents
+
+
+_sessions: Optional[list] = None
+
+
+def load_sessions() -> list:
+    """Saved sessions in client form, read through the app's history store.
+
+    Read once and remembered: the first call must come before the in-process
+    server points the store at its temporary directory.
+    """
+    global _sessions
+    if _sessions is None:
+        ids = sorted(s['id'] for s in resume_app.get_history_store().list_sessions())
+        _sessions = [resume_app.load_chat_history(session_id) for session_id in ids]
+    return _sessions
+
+
+def user_messages() -> list:
+    messages = [m['content'] for s in load_sessions() for m in s.get('messages', [])
+                if m.get('type') == 'user' and m.get('content')]
+    return messages or ['Create a resume for a software engineer with 5 years of experience']
+
+
+class Scenario:
+    """One kind of request. request(i) returns (method, path, requests kwargs)."""
+
+    name = ''
+
+    def setup(self, base_url: str, session: requests.Session):
+        pass
+
+    def request(self, i: int) -> tuple:
+        raise NotImplementedError
+
+    def teardown(self, base_url: str, session: requests.Session):
+        pass
+
+
+class CompileScenario(Scenario):
+    name = 'compile'
+
+    def __init__(self):
+        self.documents = load_documents()
+
+    def request(self, i):
+        return 'POST', '/compile', {'json': {'latex_code': self.documents[i % len(self.documents)]}}
+
+
+class ChatScenario(Scenario):
+    """Half new resumes (validate + generate), half edits of a current document."""
+
+    name = 'chat'
+
+    def __init__(self):
+        self.messages = user_messages()
+        self.documents = load_documents()
+
+    def request(self, i):
+        form = {'message': self.messages[i % len(self.messages)], 'pro_mode': 'false'}
+        if i % 2:
+            form['current_latex'] = self.documents[i % len(self.documents)]
+        return 'POST', '/chat', {'data': form}
+
+
+class ChatUrlScenario(Scenario):
+    """Messages with a profile URL, so scraping overlaps the model call."""
+
+    name = 'chat_url'
+
+    def __init__(self, site_url: str):
+        self.site_url = site_url
+        self.pages = itertools.count()
+
+    def request(self, i):
+        # A new URL every request, across levels too: scrape cache misses are the slow path
+        message = f'Make a resume from my profile {self.site_url}/profile/{next(self.pages)}'
+        return 'POST', '/chat', {'data': {'message': message, 'pro_mode': 'false'}}
+
+
+class SynctexScenario(Scenario):
+    """Alternating forward and reverse lookups on one compiled document."""
+
+    name = 'synctex'
+
+    def setup(self, base_url, session):
+        latex = resume_app.SAMPLE_TEMPLATES[next(iter(resume_app.SAMPLE_TEMPLATES))]
+        result = session.post(f'{base_url}/compile', json={'latex_code': latex}).json()
+        if not result.get('success'):
+            raise RuntimeError(f"synctex setup compile failed: {result.get('error')}")
+        self.job_id = result['pdf_url'].rsplit('/', 1)[-1]
+        self.lines = latex.count('\n') + 1
+
+    def request(self, i):
+        if i % 2:
+            return 'POST', f'/synctex/reverse/{self.job_id}', {'json': {'page': 1, 'x': 100 + i % 300, 'y': 80 + i % 600}}
+        return 'POST', f'/synctex/forward/{self.job_id}', {'json': {'line': 1 + i % self.lines}}
+
+
+class HistoryScenario(Scenario):
+    """Reads (full and paged/lazy) and PATCH appends on seeded sessions."""
+
+    name = 'history'
+
+    def setup(self, base_url, session):
+        self.session_ids = []
+        for n, stored in enumerate(load_sessions() or [{'messages': [], 'latex': '', 'checkpoints': []}]):
+            session_id = f'bench-{n}'
+            session.post(f'{base_url}/history', json=dict(stored, sessionId=session_id)).raise_for_status()
+            seeded = session.get(f'{base_url}/history', params={'sessionId': session_id}).json()
+            if len(seeded.get('messages') or []) != len(stored.get('messages') or []):
+                raise RuntimeError(f'history setup: session {session_id} was not stored')
+            self.session_ids.append(session_id)
+
+    def request(self, i):
+        session_id = self.session_ids[i % len(self.session_ids)]
+        kind = i % 3
+        if kind == 0:
+            return 'GET', '/history', {'params': {'sessionId': session_id}}
+        if kind == 1:
+            return 'GET', '/history', {'params': {'sessionId': session_id, 'checkpoints': 'lazy', 'limit': 20}}
+        message = {'type': 'user', 'content': f'benchmark message {i}', 'timestamp': int(time.time() * 1000)}
+        return 'PATCH', '/history', {'json': {'sessionId': session_id, 'ops': [{'op': 'append_message', 'message': message}]}}
+
+    def teardown(self, base_url, session):
+        for session_id in self.session_ids:
+            session.post(f'{base_url}/history/clear', json={'sessionId': session_id})
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def run_level(scenario: Scenario, base_url: str, concurrency: int, total: int, measure_cpu: bool = False) -> dict:
+    """Send `total` requests from `concurrency` closed-loop clients.
+
+    With measure_cpu, the CPU time of this process's children (the pdflatex
+    runs of an in-process server) is reported per request.
+    """
+    latencies = []
+    errors = 0
+    failures = 0
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        nonlocal errors, failures
+        session = requests.Session()
+        for i in counter:
+            method, path, kwargs = scenario.request(i)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, timeout=300, **kwargs)
+                elapsed = (time.perf_counter() - start) * 1000
+                error = response.status_code >= 400
+                failed = not error and response.headers.get('Content-Type', '').startswith('application/json') \
+                    and response.json().get('success') is False
+            except requests.RequestException:
+                elapsed = (time.perf_counter() - start) * 1000
+                error, failed = True, False
+            with lock:
+                latencies.append(elapsed)
+                errors += error
+                failures += failed
+
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    latencies.sort()
+    result = {
+        'scenario': scenario.name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'failures': failures,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 2) if duration else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'mean': round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            'max': round(latencies[-1], 1) if latencies else 0.0,
+        },
+    }
+    if measure_cpu and latencies:
+        cpu = (children_after.ru_utime - children_before.ru_utime) + (children_after.ru_stime - children_before.ru_stime)
+        result['pdflatex_cpu_s_per_compile'] = round(cpu / len(latencies), 4)
+    return result
+
+
+# Benchmarks measure capacity, so the rate limits and the model queue cap are lifted
+UNLIMITED_ADMISSION = {
+    'limits': {'chat': None, 'compile': None},
+    'queues': {'model': {'slots': 4096, 'max_waiting': 4096}},
+}
+
+
+def write_admission_config(directory: str) -> str:
+    path = os.path.join(directory, 'admission.json')
+    with open(path, 'w') as f:
+        json.dump(UNLIMITED_ADMISSION, f)
+    return path
+
+
+def start_in_process_server(history_dir: str) -> tuple:
+    """Serve the app from this process on an ephemeral port; returns (server, base_url)."""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    resume_app.CHAT_HISTORY_DIR = history_dir
+    resume_app.HISTORY_DB_PATH = os.path.join(history_dir, 'history.db')
+    resume_app._history_store = None  # A SQLite store would still point at the real database
+    resume_app.ADMISSION_CONFIG = write_admission_config(history_dir)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, resume_app.app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip()
+        except (OSError, subprocess.TimeoutExpired):
+            return ''
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def run(args) -> int:
+    history_dir = tempfile.mkdtemp(prefix='bench-history-')
+    load_sessions()  # While the store still reads chat_histories/
+    server = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        install_fake_model(args.model_latency)
+        server, base_url = start_in_process_server(history_dir)
+    site = StubSite(args.site_latency).start()
+
+    factories = {
+        'compile': CompileScenario,
+        'chat': ChatScenario,
+        'chat_url': lambda: ChatUrlScenario(site.url),
+        'synctex': SynctexScenario,
+        'history': HistoryScenario,
+    }
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in factories]
+    if unknown:
+        print(f"Unknown scenario(s): {', '.join(unknown)}; choose from {', '.join(factories)}", file=sys.stderr)
+        return 2
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    results = []
+    setup_session = requests.Session()
+    try:
+        for name in names:
+            scenario = factories[name]()
+            try:
+                scenario.setup(base_url, setup_session)
+            except (RuntimeError, requests.RequestException) as e:
+                print(f'{name}: skipped ({e})', file=sys.stderr)
+                continue
+            if args.warmup:
+                run_level(scenario, base_url, 1, args.warmup)
+            for level in levels:
+                result = run_level(scenario, base_url, level, max(args.requests, level),
+                                   measure_cpu=name == 'compile' and not args.url)
+                results.append(result)
+                latency = result['latency_ms']
+                cpu = result.get('pdflatex_cpu_s_per_compile')
+                print(f"{name:<9} c={level:<3} {result['throughput_rps']:>8.2f} req/s  "
+                      f"p50 {latency['p50']:>8.1f}  p95 {latency['p95']:>8.1f}  p99 {latency['p99']:>8.1f} ms  "
+                      f"errors {result['errors']}  failures {result['failures']}"
+                      + (f'  pdflatex cpu {cpu:.3f}s' if cpu is not None else ''))
+            scenario.teardown(base_url, setup_session)
+    finally:
+        site.stop()
+        if server:
+            server.shutdown()
+
+    output = {
+        'meta': {
+            **git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'target': args.url or 'in-process',
+            'model_latency_s': None if args.url else args.model_latency,
+            'site_latency_s': args.site_latency,
+            'pdflatex': resume_app.find_pdflatex(),
+        },
+        'results': results,
+    }
+    write_results(output, args.output)
+    return 0
+
+
+def write_results(output: dict, path: Optional[str], suffix: str = ''):
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(RESULTS_DIR, f"{stamp}-{output['meta']['commit'][:8] or 'nogit'}{suffix}.json")
+    with open(path, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'Wrote {path}')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(mode: str, workers: int, model_latency: float) -> Tuple[subprocess.Popen, str]:
+    """Serve the fake-model app with gunicorn.conf.py in SERVER_MODE `mode`; returns (process, base_url)."""
+    port = free_port()
+    env = dict(os.environ, SERVER_MODE=mode, WEB_CONCURRENCY=str(workers),
+               FAKE_MODEL_LATENCY=str(model_latency), METRICS_DIR='',
+               ADMISSION_CONFIG=write_admission_config(tempfile.mkdtemp(prefix='bench-')))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+         'benchmarks.fake_backend:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn ({mode}) exited with code {process.returncode}')
+        try:
+            requests.get(f'{base_url}/metrics', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'gunicorn ({mode}) did not start within 30s')
+
+
+def capacity(args) -> int:
+    """Compare how many concurrent /chat requests sync and async workers sustain."""
+    levels = [int(level) for level in args.concurrency.split(',')]
+    results = []
+    for mode in args.modes.split(','):
+        try:
+            process, base_url = start_gunicorn(mode, args.workers, args.model_latency)
+        except RuntimeError as e:
+            print(f'{mode}: skipped ({e})', file=sys.stderr)
+            continue
+        try:
+            for level in levels:
+                result = run_level(ChatScenario(), base_url, level, max(args.requests, level))
+                result['mode'] = mode
+                results.append(result)
+                latency = result['latency_ms']
+                print(f"{mode:<5} workers={args.workers} c={level:<4} {result['throughput_rps']:>8.2f} req/s  "
+                      f"p50 {latency['p50']:>8.1f}  p95 {latency['p95']:>8.1f} ms  errors {result['errors']}")
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    output = {
+        'meta': {
+            **git_revision(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'workers': args.workers,
+            'model_latency_s': args.model_latency,
+        },
+        'results': results,
+    }
+    write_results(output, args.output, suffix='-capacity')
+    return 0
+
+
+def compare(args) -> int:
+    """Print before/after deltas; exit 1 if any p95 regressed by more than the threshold."""
+    with open(args.before) as f:
+        before = {(r['scenario'], r['concurrency']): r for r in json.load(f)['results']}
+    with open(args.after) as f:
+        after = {(r['scenario'], r['concurrency']): r for r in json.load(f)['results']}
+
+    def change(old, new):
+        return (new - old) / old * 100 if old else 0.0
+
+    regressed = False
+    print(f"{'scenario':<9} {'c':>3}  {'p50 ms':>17}  {'p95 ms':>17}  {'req/s':>17}")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        p95_change = change(old['latency_ms']['p95'], new['latency_ms']['p95'])
+        regressed |= p95_change > args.threshold
+        print(f"{key[0]:<9} {key[1]:>3}  "
+              f"{new['latency_ms']['p50']:>8.1f} ({change(old['latency_ms']['p50'], new['latency_ms']['p50']):+5.0f}%)  "
+              f"{new['latency_ms']['p95']:>8.1f} ({p95_change:+5.0f}%)  "
+              f"{new['throughput_rps']:>8.2f} ({change(old['throughput_rps'], new['throughput_rps']):+5.0f}%)")
+    return 1 if regressed else 0
+
+
+# Dependencies app.py must not import until they are first used
+LAZY_MODULES = ('google.generativeai', 'PyPDF2', 'bs4', 'requests')
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({'ms': elapsed, 'loaded': [name for name in %r if name in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def import_time(args) -> int:
+    """Time `import app` in fresh interpreters; exit 1 over budget or if a lazy dependency loads eagerly."""
+    runs = []
+    for _ in range(args.runs + 1):  # The first run also writes the .pyc files
+        out = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=ROOT, capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    times = sorted(run['ms'] for run in runs[1:])
+    median = percentile(times, 50)
+    loaded = sorted({name for run in runs for name in run['loaded']})
+    print(f'import app: median {median:.1f} ms, min {times[0]:.1f} ms, max {times[-1]:.1f} ms '
+          f'over {len(times)} runs (budget {args.budget_ms:.0f} ms)')
+    if loaded:
+        print(f"Loaded at import time, should be lazy: {', '.join(loaded)}")
+    return 0 if median <= args.budget_ms and not loaded else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the benchmark')
+    run_parser.add_argument('--url', help='benchmark a running server instead of an in-process one')
+    run_parser.add_argument('--scenarios', default='compile,chat,chat_url,synctex,history')
+    run_parser.add_argument('--concurrency', default='1,4,16', help='comma-separated client counts')
+    run_parser.add_argument('--requests', type=int, default=50, help='requests per concurrency level')
+    run_parser.add_argument('--warmup', type=int, default=3, help='unrecorded requests per scenario')
+    run_parser.add_argument('--model-latency', type=float, default=1.0, help='fake model seconds per call')
+    run_parser.add_argument('--site-latency', type=float, default=0.1, help='stub profile site seconds per page')
+    run_parser.add_argument('--output', help='results file (default benchmarks/results/<time>-<commit>.json)')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two results files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help='allowed p95 regression in percent')
+    compare_parser.set_defaults(func=compare)
+
+    capacity_parser = commands.add_parser('capacity', help='compare sync and async gunicorn workers on /chat')
+    capacity_parser.add_argument('--modes', default='sync,async', help='SERVER_MODE values to compare')
+    capacity_parser.add_argument('--workers', type=int, default=1, help='gunicorn workers per run')
+    capacity_parser.add_argument('--concurrency', default='1,8,32,128', help='comma-separated client counts')
+    capacity_parser.add_argument('--requests', type=int, default=64, help='requests per concurrency level')
+    capacity_parser.add_argument('--model-latency', type=float, default=1.0, help='fake model seconds per call')
+    capacity_parser.add_argument('--output', help='results file (default benchmarks/results/<time>-<commit>-capacity.json)')
+    capacity_parser.set_defaults(func=capacity)
+
+    import_parser = commands.add_parser('import-time', help='check the import time of app.py against a budget')
+    import_parser.add_argument('--runs', type=int, default=5)
+    import_parser.add_argument('--budget-ms', type=float, default=400.0)
+    import_parser.set_defaults(func=import_time)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Stand-ins for the app's external dependencies, for benchmarks.
+
+- FakeModel replaces both Gemini models with fixed, configurable latency, so
+  /chat can be measured without an API key or quota.
+- StubSite is a local HTTP server with profile pages for URL scraping.
+
+`app` is the Flask app with the fake model installed, for running the
+benchmark target under a real server:
+
+    FAKE_MODEL_LATENCY=1.0 gunicorn --workers 2 'benchmarks.fake_backend:app'
+"""
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as resume_app  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeModel:
+    """Answers like Gemini would for each prompt the app sends, after `latency` seconds."""
+
+    def __init__(self, latency: float = 1.0):
+        self.latency = latency
+        self.documents = list(resume_app.SAMPLE_TEMPLATES.values())
+        self._calls = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.latency)
+        first = contents[0] if isinstance(contents, list) and contents else contents
+        if first == resume_app.VALIDATION_PROMPT:
+            return FakeResponse('GENERATE')
+        with self._lock:
+            self._calls += 1
+            document = self.documents[self._calls % len(self.documents)]
+        return FakeResponse(document)
+
+
+def install_fake_model(latency: float = 1.0) -> FakeModel:
+    """Route every Gemini call of the app to a FakeModel."""
+    model = FakeModel(latency)
+    resume_app.get_model = lambda pro_mode=False: model
+    return model
+
+
+PROFILE_PAGE = """<!DOCTYPE html>
+<html><head><title>{name} - Senior Software Engineer</title>
+<meta name="description" content="{name} builds distributed systems.">
+</head><body>
+<h1>{name}</h1>
+<p>Senior Software Engineer with {years} years of experience in Python, Go and Kubernetes.</p>
+{jobs}
+</body></html>
+"""
+
+
+class StubSite:
+    """Local HTTP server serving generated profile pages at /profile/<n>."""
+
+    def __init__(self, latency: float = 0.1):
+        latency_s = latency
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency_s)
+                number = self.path.rstrip('/').rsplit('/', 1)[-1]
+                jobs = '\n'.join(
+                    f'<h2>Company {i}</h2><p>Led a team of {i + 2} engineers shipping feature {i}.</p>'
+                    for i in range(20)
+                )
+                body = PROFILE_PAGE.format(name=f'Person {number}', years=5 + len(number), jobs=jobs).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self) -> 'StubSite':
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+install_fake_model(float(os.getenv('FAKE_MODEL_LATENCY', 1.0)))
+app = resume_app.app
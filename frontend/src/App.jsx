@@ -107,7 +107,7 @@ function AppContent() {
     try {
       const response = await fetch('/compile', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'X-Session-Id': currentSessionId || '' },
         body: JSON.stringify({ 
           latex_code: latex,
           session_id: currentSessionId  // Pass session ID for image support
@@ -116,8 +116,8 @@ function AppContent() {
 
       const data = await response.json();
       if (data.success && data.pdf_url) {
-        // Use the URL returned by the backend with cache-busting timestamp
-        updateCurrentSession({ pdfUrl: `${data.pdf_url}?t=${Date.now()}` });
+        // Job ids are unique per compile, so the URL itself is the cache key
+        updateCurrentSession({ pdfUrl: data.pdf_url });
       } else {
         showToast(data.error || 'Compilation failed', 'error');
       }
@@ -162,6 +162,7 @@ function AppContent() {
 
       const response = await fetch('/chat', {
         method: 'POST',
+        headers: { 'X-Session-Id': requestSessionId || '' },  // Lets the server rate-limit per session
         body: formData,
         signal: abortControllerRef.current.signal
       });
@@ -0,0 +1,23 @@
+"""Gunicorn settings. SERVER_MODE picks how each worker serves requests.
+
+- sync (default): one request per worker at a time.
+- async: gevent workers. Gemini calls, URL fetches and pdflatex/synctex
+  subprocesses wait cooperatively, so one worker holds up to
+  WORKER_CONNECTIONS requests in flight. Needs `pip install gevent`.
+"""
+import os
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'sync').lower()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+timeout = 120
+
+if SERVER_MODE == 'async':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+    # The app must be imported after gevent patches the worker; locks and
+    # queues created before that would block the whole worker
+    preload_app = False
+elif SERVER_MODE != 'sync':
+    raise ValueError(f'SERVER_MODE must be sync or async, not {SERVER_MODE!r}')
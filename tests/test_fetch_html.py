@@ -0,0 +1,111 @@
+"""fetch_html against a local HTTP stand-in: byte cap, early stop, TTL cache."""
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class StandIn:
+    """Serves `pages` ({path: bytes}) and counts the requests for each path."""
+
+    def __init__(self, pages: dict):
+        stand_in = self
+        self.pages = pages
+        self.hits = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.hits[self.path] = stand_in.hits.get(self.path, 0) + 1
+                body = stand_in.pages.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # The client stopped reading early, as it should
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+CHUNK = 16384  # fetch_html's read size
+
+PAGES = {
+    '/big': b'<html><body>' + b'x' * (1024 * 1024) + b'</body></html>',
+    # '</head>' straddles the first and second chunk; a megabyte of body follows
+    '/split-head': b'<html><head>' + b' ' * (CHUNK - 3 - len('<html><head>')) + b'</head><body>'
+                   + b'y' * (1024 * 1024) + b'</body></html>',
+    '/page': b'<html><head><title>Cached</title></head></html>',
+}
+
+
+@pytest.fixture
+def site():
+    app.clear_scrape_cache()
+    stand_in = StandIn(dict(PAGES))
+    yield stand_in
+    stand_in.close()
+    app.clear_scrape_cache()
+
+
+def test_body_is_capped(site, monkeypatch):
+    monkeypatch.setattr(app, 'SCRAPE_MAX_BYTES', 50000)
+    status, html = app.fetch_html(site.url + '/big', {})
+    assert status == 200
+    assert len(html) == 50000
+
+
+def test_stops_at_marker_split_across_chunks(site):
+    status, html = app.fetch_html(site.url + '/split-head', {}, stop_at='</head>')
+    assert status == 200
+    assert '</head>' in html
+    assert len(html) <= 2 * CHUNK
+
+
+def test_pages_are_cached_until_ttl(site, monkeypatch):
+    assert app.fetch_html(site.url + '/page', {}) == app.fetch_html(site.url + '/page', {})
+    assert site.hits['/page'] == 1
+
+    monkeypatch.setattr(app, 'SCRAPE_CACHE_TTL', 0)
+    app.clear_scrape_cache()
+    app.fetch_html(site.url + '/page', {})
+    app.fetch_html(site.url + '/page', {})
+    assert site.hits['/page'] == 3
+
+
+def test_errors_are_not_cached(site):
+    assert app.fetch_html(site.url + '/missing', {})[0] == 404
+    assert app.fetch_html(site.url + '/missing', {})[0] == 404
+    assert site.hits['/missing'] == 2
+
+
+def test_cache_is_bounded_by_bytes(site, monkeypatch):
+    monkeypatch.setattr(app, 'SCRAPE_CACHE_MAX_BYTES', 150000)
+    for n in range(4):
+        site.pages[f'/p{n}'] = b'z' * 60000
+        app.fetch_html(site.url + f'/p{n}', {})
+    assert app._scrape_cache_bytes <= 150000
+    assert list(app._scrape_cache) == [site.url + '/p2', site.url + '/p3']
+
+    app.fetch_html(site.url + '/big', {})  # Larger than the whole cache: not cached
+    assert site.url + '/big' not in app._scrape_cache
@@ -0,0 +1,198 @@
+"""Chat history storage: journal replay, checkpoint encoding and the SQLite import."""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def history_dir(tmp_path, monkeypatch):
+    """File-backed history in a temporary directory."""
+    monkeypatch.setattr(app, 'CHAT_HISTORY_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'HISTORY_BACKEND', 'file')
+    monkeypatch.setattr(app, '_history_store', None)
+    return tmp_path
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def backend(request, history_dir, monkeypatch):
+    """Each history backend in turn, behind the Flask test client."""
+    monkeypatch.setattr(app, 'HISTORY_BACKEND', request.param)
+    monkeypatch.setattr(app, 'HISTORY_DB_PATH', str(history_dir / 'history.db'))
+    return app.app.test_client()
+
+
+def resume(n: int) -> str:
+    """A document whose nth version differs from the previous one by a line or two."""
+    lines = ['\\documentclass{article}', '\\begin{document}']
+    lines += [f'\\section{{Job {i}}} Shipped feature {i} for team {i % 3}.' for i in range(n + 1)]
+    return '\n'.join(lines + ['\\end{document}']) + '\n'
+
+
+def session_with_checkpoints(n: int) -> dict:
+    """n checkpoints, each referenced by the assistant message that created it."""
+    checkpoints = [{'id': f'cp{i}', 'timestamp': i, 'latex': resume(i)} for i in range(n)]
+    messages = []
+    for checkpoint in checkpoints:
+        messages.append({'type': 'user', 'content': f'add job {checkpoint["timestamp"]}'})
+        messages.append({'type': 'assistant', 'content': 'Done', 'checkpoint': dict(checkpoint)})
+    return {'messages': messages, 'latex': resume(n - 1), 'checkpoints': checkpoints}
+
+
+def fresh_read(chat_id: str) -> dict:
+    """Read a session from disk with a new store, bypassing every in-memory cache."""
+    return app.decode_chat_history(app.FileHistoryStore().read(chat_id))
+
+
+def session(n_messages: int, latex: str = 'x') -> dict:
+    return {
+        'messages': [{'type': 'user', 'content': f'message {i}'} for i in range(n_messages)],
+        'latex': latex,
+        'checkpoints': [],
+    }
+
+
+def test_import_includes_journal_only_sessions(history_dir):
+    app.save_chat_history(session(3), 'journal-only')
+    assert not (history_dir / 'journal-only.json').exists()
+
+    store = app.SQLiteHistoryStore(str(history_dir / 'history.db'))
+    assert app.import_json_histories(store) == (1, 0)
+    assert app.decode_chat_history(store.read('journal-only')) == session(3)
+
+
+def test_import_replays_snapshot_and_journal(history_dir, monkeypatch):
+    monkeypatch.setattr(app, 'HISTORY_COMPACT_EVERY', 2)
+    n = 0
+    while not (history_dir / 'compacted.json').exists():
+        n += 1
+        app.save_chat_history(session(n), 'compacted')
+    app.save_chat_history(session(n + 1), 'compacted')  # Lands in the journal, after the snapshot
+    assert (history_dir / 'compacted.journal').stat().st_size > 0
+
+    store = app.SQLiteHistoryStore(str(history_dir / 'history.db'))
+    assert app.import_json_histories(store) == (1, 0)
+    assert app.decode_chat_history(store.read('compacted')) == session(n + 1)
+    assert app.import_json_histories(store) == (0, 1)
+
+
+def test_journal_replays_to_the_saved_state(history_dir):
+    for n in range(1, 6):
+        app.save_chat_history(session(n, latex=f'v{n}'), 'replay')
+    assert not (history_dir / 'replay.json').exists()
+    assert fresh_read('replay') == session(5, latex='v5')
+
+
+def test_torn_journal_line_is_skipped(history_dir):
+    app.save_chat_history(session(2), 'torn')
+    with open(history_dir / 'torn.journal', 'a') as f:
+        f.write('{"seq": 99, "op": "ext')  # A write cut short by a crash
+    assert fresh_read('torn') == session(2)
+
+    app.save_chat_history(session(3), 'torn')
+    assert fresh_read('torn') == session(3)
+
+
+def test_compaction_writes_snapshot_and_empties_journal(history_dir, monkeypatch):
+    monkeypatch.setattr(app, 'HISTORY_COMPACT_EVERY', 3)
+    n = 0
+    while not (history_dir / 'compact.json').exists():
+        n += 1
+        app.save_chat_history(session(n), 'compact')
+    assert json.loads((history_dir / 'compact.json').read_text())['journalSeq'] >= 3
+    assert (history_dir / 'compact.journal').stat().st_size == 0
+    assert fresh_read('compact') == session(n)
+
+
+def test_crash_between_snapshot_and_truncate(history_dir, monkeypatch):
+    """Entries already folded into the snapshot must not be applied twice."""
+    monkeypatch.setattr(app, 'HISTORY_COMPACT_EVERY', 3)
+    journal = history_dir / 'crash.journal'
+    before_truncate = {}
+    write_snapshot = app.write_snapshot_atomic
+
+    def snapshot_then_remember(file_path, data):
+        write_snapshot(file_path, data)
+        before_truncate['journal'] = journal.read_bytes()
+
+    monkeypatch.setattr(app, 'write_snapshot_atomic', snapshot_then_remember)
+    n = 0
+    while not before_truncate:
+        n += 1
+        app.save_chat_history(session(n), 'crash')
+    journal.write_bytes(before_truncate['journal'])  # As if we died before truncating
+    assert fresh_read('crash') == session(n)
+
+    app.save_chat_history(session(n + 1), 'crash')
+    assert fresh_read('crash') == session(n + 1)
+
+
+def test_checkpoints_are_keyframes_and_deltas():
+    checkpoints = [{'id': i, 'latex': resume(i)} for i in range(25)]
+    encoded = app.encode_checkpoints(checkpoints, [])
+    keyframes = [i for i, cp in enumerate(encoded) if 'latexFull' in cp]
+    assert keyframes == [0, 10, 20]
+    assert all('latexDelta' in cp for i, cp in enumerate(encoded) if i not in keyframes)
+    assert all('latex' not in cp for cp in encoded)
+    assert [app.checkpoint_latex(encoded, i) for i in range(25)] == [cp['latex'] for cp in checkpoints]
+
+
+def test_unchanged_checkpoints_reuse_stored_encoding():
+    checkpoints = [{'id': i, 'latex': resume(i)} for i in range(5)]
+    first = app.encode_checkpoints(checkpoints, [])
+    again = app.encode_checkpoints(checkpoints + [{'id': 5, 'latex': resume(5)}], first)
+    assert again[:5] == first
+    assert app.checkpoint_latex(again, 5) == resume(5)
+
+
+def test_messages_reference_checkpoints_by_hash(history_dir):
+    data = session_with_checkpoints(3)
+    app.save_chat_history(data, 'refs')
+    stored = app.FileHistoryStore().read('refs')
+    refs = [m['checkpoint'] for m in stored['messages'] if 'checkpoint' in m]
+    assert refs and all('latexRef' in ref and 'latex' not in ref for ref in refs)
+    assert fresh_read('refs') == data
+
+    lazy = app.decode_chat_history(stored, lazy_checkpoints=True)
+    assert all('latex' not in cp for cp in lazy['checkpoints'])
+    assert all('latex' not in m['checkpoint'] for m in lazy['messages'] if 'checkpoint' in m)
+
+
+def test_lazy_stubs_posted_back_keep_their_latex(backend):
+    data = session_with_checkpoints(4)
+    backend.post('/history', json={**data, 'sessionId': 'lazy'})
+    lazy = backend.get('/history', query_string={'sessionId': 'lazy', 'checkpoints': 'lazy'}).json
+    lazy['messages'].append({'type': 'user', 'content': 'thanks'})
+    assert backend.post('/history', json={**lazy, 'sessionId': 'lazy'}).json['success']
+
+    expected = {**data, 'messages': data['messages'] + [{'type': 'user', 'content': 'thanks'}]}
+    assert backend.get('/history', query_string={'sessionId': 'lazy'}).json == expected
+    checkpoint = backend.get('/history/checkpoint', query_string={'sessionId': 'lazy', 'id': 'cp2'}).json
+    assert checkpoint['latex'] == resume(2)
+
+
+def test_post_and_patch_round_trip(backend):
+    data = session_with_checkpoints(2)
+    backend.post('/history', json={**data, 'sessionId': 'trip'})
+    checkpoint = {'id': 'cp2', 'timestamp': 2, 'latex': resume(2)}
+    ops = [
+        {'op': 'add_checkpoint', 'checkpoint': checkpoint},
+        {'op': 'append_message', 'message': {'type': 'assistant', 'content': 'Done', 'checkpoint': checkpoint}},
+        {'op': 'set_latex', 'latex': resume(2)},
+    ]
+    assert backend.patch('/history', json={'sessionId': 'trip', 'ops': ops}).json['success']
+
+    expected = {
+        'messages': data['messages'] + [{'type': 'assistant', 'content': 'Done', 'checkpoint': checkpoint}],
+        'latex': resume(2),
+        'checkpoints': data['checkpoints'] + [checkpoint],
+    }
+    assert backend.get('/history', query_string={'sessionId': 'trip'}).json == expected
+    page = backend.get('/history', query_string={'sessionId': 'trip', 'limit': 2}).json
+    assert page['messages'] == expected['messages'][-2:]
+    assert (page['messageOffset'], page['messageCount']) == (3, 5)